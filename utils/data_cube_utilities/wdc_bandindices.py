@@ -17,9 +17,725 @@ Last modified: March 2021
 '''
 
 # Import required packages
+import re
 import warnings
 import numpy as np
 import math
+import xarray as xr
+from types import SimpleNamespace
+
+# Remote sensing index band recipes. Each recipe takes an object exposing
+# the required spectral bands as attributes (e.g. `ds.nir`) and returns
+# the index computed from them.
+_INDEX_RECIPES = {
+    # Normalised Difference Vegation Index, Rouse 1973
+    'NDVI': lambda ds: (ds.nir - ds.red) /
+                       (ds.nir + ds.red),
+
+    # Green Normalised Difference Vegetation Index, Gitelson and Merzlyak 1998
+    'GNDVI': lambda ds: (ds.nir - ds.green) /
+                       (ds.nir + ds.green),
+
+    # Non-linear Normalised Difference Vegation Index,
+    # Camps-Valls et al. 2021
+    'kNDVI': lambda ds: np.tanh(((ds.nir - ds.red) /
+                                 (ds.nir + ds.red)) ** 2),
+
+    # Enhanced Vegetation Index, Huete 2002
+    'EVI': lambda ds: ((2.5 * (ds.nir - ds.red)) /
+                       (ds.nir + 6 * ds.red -
+                        7.5 * ds.blue + 1)),
+
+    # Leaf Area Index, Boegh 2002
+    'LAI': lambda ds: (3.618 * ((2.5 * (ds.nir - ds.red)) /
+                       (ds.nir + 6 * ds.red -
+                        7.5 * ds.blue + 1)) - 0.118),
+
+    # Soil Adjusted Vegetation Index, Huete 1988
+    'SAVI': lambda ds: ((1.5 * (ds.nir - ds.red)) /
+                        (ds.nir + ds.red + 0.5)),
+
+    # Mod. Soil Adjusted Vegetation Index, Qi et al. 1994
+    'MSAVI': lambda ds: ((2 * ds.nir + 1 - 
+                        ((2 * ds.nir + 1)**2 - 
+                         8 * (ds.nir - ds.red))**0.5) / 2),
+
+    # Wide Dynamic Range Vegetation Index, Peng and Gitelson 2011
+    'WDRVI': lambda ds: ((0.2 * ds.nir - ds.red) /
+                          (0.2 * ds.nir + ds.red) +
+                          (1 - 0.2)/(1 + 0.2)),
+
+    # Vegetation Index Green, Gitelson et al. 2002
+    'VARIg': lambda ds: ((ds.green - ds.red) /
+                          (ds.green + ds.red - ds.blue)),
+
+    # Inverted Red-Edge Chlorophyll Index, Clevers et al., 2000
+    'IRECI': lambda ds: ((ds.veg7 - ds.red) /
+                          (ds.veg5 / ds.veg6)),
+
+    # Chlorophyll Index - red edge, Gitelson et al. 2005
+    'CIre': lambda ds: ((ds.veg7 / ds.veg5) - 1),
+
+    # Chlorophyll Index - green, Gitelson et al. 2005
+    'CIg': lambda ds: ((ds.veg7 / ds.green) - 1),
+
+    # Modified Chlorophyll Absorption in Reflectance Index 2, Haboudane et al. 2004
+    'MCARI2': lambda ds: (1.5 * (2.5 * (ds.veg7 - ds.red) -
+                          1.3 * (ds.veg7 - ds.green)) /
+                          math.sqrt(((2.0 * ds.veg7 + 1.0) ** 2.0) -
+                          (6.0 * ds.veg7 - 5.0 * math.sqrt(ds.red)) -
+                          0.5)),
+
+    # Plant Senescence Reflectance Index, Merzlyak et al. 1999
+    'PSRI': lambda ds: ((ds.red - ds.blue) / ds.veg6),
+
+    # Sentinel2 Red Edge Position
+    'S2REP': lambda ds: (705 + 35*((ds.red + ds.veg7) / 2 - ds.veg5 ) /
+                        (ds.veg6 - ds.veg5)),
+
+    # Anthocyanin reflectance index, Gitelson et al. 2009
+    'ARI': lambda ds: ( (1 / ds.green) - (1 / ds.veg5)),
+
+    #Moisture Stress Index, 
+    'MSI': lambda ds: (ds.swir1 / ds.nir),
+
+    # Normalised Difference Moisture Index, Gao 1996
+    'NDMI': lambda ds: (ds.nir - ds.swir1) /
+                       (ds.nir + ds.swir1),
+
+    # Normalised Burn Ratio, Lopez Garcia 1991
+    'NBR': lambda ds: (ds.nir - ds.swir2) /
+                      (ds.nir + ds.swir2),
+
+    # Burn Area Index, Martin 1998
+    'BAI': lambda ds: (1.0 / ((0.10 - ds.red) ** 2 +
+                              (0.06 - ds.nir) ** 2)),
+
+   # Normalised Difference Chlorophyll Index, Mishra & Mishra, 2012
+    'NDCI': lambda ds: (ds.veg5 - ds.red) /
+                       (ds.veg5 + ds.red),
+
+    # Normalised Difference Snow Index, Hall 1995
+    'NDSI': lambda ds: (ds.green - ds.swir1) /
+                       (ds.green + ds.swir1),
+
+    # Normalised Difference Tillage Index,
+    # Van Deventer et al. 1997
+    'NDTI': lambda ds: (ds.swir1 - ds.swir2) /
+                       (ds.swir1 + ds.swir2),
+
+    # Normalised Difference Water Index, McFeeters 1996
+    'NDWI': lambda ds: (ds.green - ds.nir) /
+                       (ds.green + ds.nir),
+
+    # Modified Normalised Difference Water Index, Xu 2006
+    'MNDWI': lambda ds: (ds.green - ds.swir1) /
+                        (ds.green + ds.swir1),
+
+    # Normalised Difference Built-Up Index, Zha 2003
+    'NDBI': lambda ds: (ds.swir1 - ds.nir) /
+                       (ds.swir1 + ds.nir),
+
+    # Built-Up Index, He et al. 2010
+    'BUI': lambda ds:  ((ds.swir1 - ds.nir) /
+                        (ds.swir1 + ds.nir)) -
+                       ((ds.nir - ds.red) /
+                        (ds.nir + ds.red)),
+
+    # Built-up Area Extraction Index, Bouzekri et al. 2015
+    'BAEI': lambda ds: (ds.red + 0.3) /
+                       (ds.green + ds.swir1),
+
+    # New Built-up Index, Jieli et al. 2010
+    'NBI': lambda ds: (ds.swir1 + ds.red) / ds.nir,
+
+    # Bare Soil Index, Rikimaru et al. 2002
+    'BSI': lambda ds: ((ds.swir1 + ds.red) - 
+                       (ds.nir + ds.blue)) / 
+                      ((ds.swir1 + ds.red) + 
+                       (ds.nir + ds.blue)),
+
+    # Automated Water Extraction Index (no shadows), Feyisa 2014
+    'AWEI_ns': lambda ds: (4 * (ds.green - ds.swir1) -
+                          (0.25 * ds.nir * + 2.75 * ds.swir2)),
+
+    # Automated Water Extraction Index (shadows), Feyisa 2014
+    'AWEI_sh': lambda ds: (ds.blue + 2.5 * ds.green -
+                           1.5 * (ds.nir + ds.swir1) -
+                           0.25 * ds.swir2),
+
+    # Water Index, Fisher 2016
+    'WI': lambda ds: (1.7204 + 171 * ds.green + 3 * ds.red -
+                      70 * ds.nir - 45 * ds.swir1 -
+                      71 * ds.swir2),
+
+    # Tasseled Cap Wetness, Crist 1985
+    'TCW': lambda ds: (0.0315 * ds.blue + 0.2021 * ds.green +
+                       0.3102 * ds.red + 0.1594 * ds.nir +
+                      -0.6806 * ds.swir1 + -0.6109 * ds.swir2),
+
+    # Tasseled Cap Greeness, Crist 1985
+    'TCG': lambda ds: (-0.1603 * ds.blue + -0.2819 * ds.green +
+                       -0.4934 * ds.red + 0.7940 * ds.nir +
+                       -0.0002 * ds.swir1 + -0.1446 * ds.swir2),
+
+    # Tasseled Cap Brightness, Crist 1985
+    'TCB': lambda ds: (0.2043 * ds.blue + 0.4158 * ds.green +
+                       0.5524 * ds.red + 0.5741 * ds.nir +
+                       0.3124 * ds.swir1 + -0.2303 * ds.swir2),
+
+    # Tasseled Cap Transformations with Sentinel-2 coefficients 
+    # after Nedkov 2017 using Gram-Schmidt orthogonalization (GSO)
+    # Tasseled Cap Wetness, Nedkov 2017
+    'TCW_GSO': lambda ds: (0.0649 * ds.blue + 0.2802 * ds.green +
+                           0.3072 * ds.red + -0.0807 * ds.nir +
+                          -0.4064 * ds.swir1 + -0.5602 * ds.swir2),
+
+    # Tasseled Cap Greeness, Nedkov 2017
+    'TCG_GSO': lambda ds: (-0.0635 * ds.blue + -0.168 * ds.green +
+                           -0.348 * ds.red + 0.3895 * ds.nir +
+                           -0.4587 * ds.swir1 + -0.4064 * ds.swir2),
+
+    # Tasseled Cap Brightness, Nedkov 2017
+    'TCB_GSO': lambda ds: (0.0822 * ds.blue + 0.136 * ds.green +
+                           0.2611 * ds.red + 0.5741 * ds.nir +
+                           0.3882 * ds.swir1 + 0.1366 * ds.swir2),
+
+    # Clay Minerals Ratio, Drury 1987
+    'CMR': lambda ds: (ds.swir1 / ds.swir2),
+
+    # Ferrous Minerals Ratio, Segal 1982
+    'FMR': lambda ds: (ds.swir1 / ds.nir),
+
+    # Iron Oxide Ratio, Segal 1982
+    'IOR': lambda ds: (ds.red / ds.blue)
+}
+
+
+# Spectral bands read by each recipe in `_INDEX_RECIPES`. This lets
+# `calculate_indices` read and normalise every band needed by a set of
+# indices once per block, rather than once per index.
+_INDEX_BANDS = {
+    'NDVI': ('nir', 'red'),
+    'GNDVI': ('nir', 'green'),
+    'kNDVI': ('nir', 'red'),
+    'EVI': ('nir', 'red', 'blue'),
+    'LAI': ('nir', 'red', 'blue'),
+    'SAVI': ('nir', 'red'),
+    'MSAVI': ('nir', 'red'),
+    'WDRVI': ('nir', 'red'),
+    'VARIg': ('green', 'red', 'blue'),
+    'IRECI': ('veg7', 'red', 'veg5', 'veg6'),
+    'CIre': ('veg7', 'veg5'),
+    'CIg': ('veg7', 'green'),
+    'MCARI2': ('veg7', 'red', 'green'),
+    'PSRI': ('red', 'blue', 'veg6'),
+    'S2REP': ('red', 'veg7', 'veg5', 'veg6'),
+    'ARI': ('green', 'veg5'),
+    'MSI': ('swir1', 'nir'),
+    'NDMI': ('nir', 'swir1'),
+    'NBR': ('nir', 'swir2'),
+    'BAI': ('red', 'nir'),
+    'NDCI': ('veg5', 'red'),
+    'NDSI': ('green', 'swir1'),
+    'NDTI': ('swir1', 'swir2'),
+    'NDWI': ('green', 'nir'),
+    'MNDWI': ('green', 'swir1'),
+    'NDBI': ('swir1', 'nir'),
+    'BUI': ('swir1', 'nir', 'red'),
+    'BAEI': ('red', 'green', 'swir1'),
+    'NBI': ('swir1', 'red', 'nir'),
+    'BSI': ('swir1', 'red', 'nir', 'blue'),
+    'AWEI_ns': ('green', 'swir1', 'nir', 'swir2'),
+    'AWEI_sh': ('blue', 'green', 'nir', 'swir1', 'swir2'),
+    'WI': ('green', 'red', 'nir', 'swir1', 'swir2'),
+    'TCW': ('blue', 'green', 'red', 'nir', 'swir1', 'swir2'),
+    'TCG': ('blue', 'green', 'red', 'nir', 'swir1', 'swir2'),
+    'TCB': ('blue', 'green', 'red', 'nir', 'swir1', 'swir2'),
+    'TCW_GSO': ('blue', 'green', 'red', 'nir', 'swir1', 'swir2'),
+    'TCG_GSO': ('blue', 'green', 'red', 'nir', 'swir1', 'swir2'),
+    'TCB_GSO': ('blue', 'green', 'red', 'nir', 'swir1', 'swir2'),
+    'CMR': ('swir1', 'swir2'),
+    'FMR': ('swir1', 'nir'),
+    'IOR': ('red', 'blue'),
+}
+
+# The same recipes as `_INDEX_RECIPES`, written as numexpr expressions.
+# numexpr evaluates an expression in small cache-sized chunks without
+# allocating a full-size temporary per operator, and caches the compiled
+# kernel for each (expression, input dtype) pair so it is only built once.
+# Their numeric literals are passed as typed variables (see
+# `_numexpr_kernel`), as numexpr would otherwise treat them as float64
+# and evaluate the whole expression in float64.
+_INDEX_EXPRESSIONS = {
+    'NDVI': '(nir - red) / (nir + red)',
+    'GNDVI': '(nir - green) / (nir + green)',
+    'kNDVI': 'tanh(((nir - red) / (nir + red)) ** 2)',
+    'EVI': '(2.5 * (nir - red)) / (nir + 6 * red - 7.5 * blue + 1)',
+    'LAI': '3.618 * ((2.5 * (nir - red)) / (nir + 6 * red - 7.5 * blue + 1)) '
+           '- 0.118',
+    'SAVI': '(1.5 * (nir - red)) / (nir + red + 0.5)',
+    'MSAVI': '(2 * nir + 1 - ((2 * nir + 1) ** 2 - 8 * (nir - red)) ** 0.5) / 2',
+    'WDRVI': '(0.2 * nir - red) / (0.2 * nir + red) + (1 - 0.2) / (1 + 0.2)',
+    'VARIg': '(green - red) / (green + red - blue)',
+    'IRECI': '(veg7 - red) / (veg5 / veg6)',
+    'CIre': '(veg7 / veg5) - 1',
+    'CIg': '(veg7 / green) - 1',
+    'MCARI2': '1.5 * (2.5 * (veg7 - red) - 1.3 * (veg7 - green)) / '
+              'sqrt(((2.0 * veg7 + 1.0) ** 2.0) - '
+              '(6.0 * veg7 - 5.0 * sqrt(red)) - 0.5)',
+    'PSRI': '(red - blue) / veg6',
+    'S2REP': '705 + 35 * ((red + veg7) / 2 - veg5) / (veg6 - veg5)',
+    'ARI': '(1 / green) - (1 / veg5)',
+    'MSI': 'swir1 / nir',
+    'NDMI': '(nir - swir1) / (nir + swir1)',
+    'NBR': '(nir - swir2) / (nir + swir2)',
+    'BAI': '1.0 / ((0.10 - red) ** 2 + (0.06 - nir) ** 2)',
+    'NDCI': '(veg5 - red) / (veg5 + red)',
+    'NDSI': '(green - swir1) / (green + swir1)',
+    'NDTI': '(swir1 - swir2) / (swir1 + swir2)',
+    'NDWI': '(green - nir) / (green + nir)',
+    'MNDWI': '(green - swir1) / (green + swir1)',
+    'NDBI': '(swir1 - nir) / (swir1 + nir)',
+    'BUI': '((swir1 - nir) / (swir1 + nir)) - ((nir - red) / (nir + red))',
+    'BAEI': '(red + 0.3) / (green + swir1)',
+    'NBI': '(swir1 + red) / nir',
+    'BSI': '((swir1 + red) - (nir + blue)) / ((swir1 + red) + (nir + blue))',
+    'AWEI_ns': '4 * (green - swir1) - (0.25 * nir * + 2.75 * swir2)',
+    'AWEI_sh': 'blue + 2.5 * green - 1.5 * (nir + swir1) - 0.25 * swir2',
+    'WI': '1.7204 + 171 * green + 3 * red - 70 * nir - 45 * swir1 '
+          '- 71 * swir2',
+    'TCW': '0.0315 * blue + 0.2021 * green + 0.3102 * red + 0.1594 * nir '
+           '+ -0.6806 * swir1 + -0.6109 * swir2',
+    'TCG': '-0.1603 * blue + -0.2819 * green + -0.4934 * red + 0.7940 * nir '
+           '+ -0.0002 * swir1 + -0.1446 * swir2',
+    'TCB': '0.2043 * blue + 0.4158 * green + 0.5524 * red + 0.5741 * nir '
+           '+ 0.3124 * swir1 + -0.2303 * swir2',
+    'TCW_GSO': '0.0649 * blue + 0.2802 * green + 0.3072 * red + -0.0807 * nir '
+               '+ -0.4064 * swir1 + -0.5602 * swir2',
+    'TCG_GSO': '-0.0635 * blue + -0.168 * green + -0.348 * red + 0.3895 * nir '
+               '+ -0.4587 * swir1 + -0.4064 * swir2',
+    'TCB_GSO': '0.0822 * blue + 0.136 * green + 0.2611 * red + 0.5741 * nir '
+               '+ 0.3882 * swir1 + 0.1366 * swir2',
+    'CMR': 'swir1 / swir2',
+    'FMR': 'swir1 / nir',
+    'IOR': 'red / blue',
+}
+
+# Coefficients of the tasselled cap transformations, applied to the bands
+# in `_TASSELLED_CAP_BANDS`. These are the linear combinations used by the
+# 'TCB', 'TCG' and 'TCW' recipes and their '_GSO' variants, computed all
+# together with one matrix multiply when several of them are requested.
+_TASSELLED_CAP_BANDS = ('blue', 'green', 'red', 'nir', 'swir1', 'swir2')
+_TASSELLED_CAP = {
+    # Tasseled Cap Transformations, Crist 1985
+    'TCB': (0.2043, 0.4158, 0.5524, 0.5741, 0.3124, -0.2303),
+    'TCG': (-0.1603, -0.2819, -0.4934, 0.7940, -0.0002, -0.1446),
+    'TCW': (0.0315, 0.2021, 0.3102, 0.1594, -0.6806, -0.6109),
+
+    # Tasseled Cap Transformations with Sentinel-2 coefficients after
+    # Nedkov 2017 using Gram-Schmidt orthogonalization (GSO)
+    'TCB_GSO': (0.0822, 0.136, 0.2611, 0.5741, 0.3882, 0.1366),
+    'TCG_GSO': (-0.0635, -0.168, -0.348, 0.3895, -0.4587, -0.4064),
+    'TCW_GSO': (0.0649, 0.2802, 0.3072, -0.0807, -0.4064, -0.5602),
+}
+
+# Number of elements per band processed in each pass of the fused index
+# engine. Small enough for a block of every input band plus the recipe
+# temporaries to stay in cache, large enough to amortise Python overhead.
+_BLOCK_SIZE = 2 ** 16
+
+# Fraction of valid pixels in a block below which `valid_only` packs the
+# valid pixels before evaluating the indices. Above it, packing and
+# scattering the pixels back costs more than evaluating the whole block
+# (see `wdc_benchmarks.benchmark_valid_only`).
+_VALID_ONLY_DENSITY = 0.25
+
+# Block size used with the numexpr backend. numexpr already splits its
+# input into cache-sized chunks (and across threads), so it is given
+# larger blocks to amortise the overhead of each `numexpr.evaluate` call.
+_NUMEXPR_BLOCK_SIZE = 2 ** 18
+
+# Numeric literals of a numexpr expression, other than exponents (which
+# numexpr expands into multiplications or a square root itself).
+_NUMEXPR_LITERAL = re.compile(r'(?<![\w.])(\*\*\s*)?(\d+\.?\d*|\.\d+)')
+
+
+def _iter_blocks(shape, block_size=_BLOCK_SIZE):
+    """
+    Yield tuples of slices that split an array of `shape` into blocks of
+    at most `block_size` elements (or a single row of the innermost
+    dimension, whichever is larger), splitting along leading dimensions
+    first.
+    """
+    if len(shape) == 0:
+        yield ()
+        return
+
+    row_size = int(np.prod(shape[1:]))
+    if row_size <= block_size or len(shape) == 1:
+        step = max(1, block_size // max(row_size, 1))
+        for start in range(0, shape[0], step):
+            yield (slice(start, start + step),)
+    else:
+        for i in range(shape[0]):
+            for block in _iter_blocks(shape[1:], block_size):
+                yield (slice(i, i + 1),) + block
+
+
+def _numexpr_kernel(expression, dtype):
+    """
+    Return `expression` with its numeric literals replaced by variables
+    ('c0', 'c1', ...), and a dictionary of those variables as `dtype`
+    scalars, so that numexpr evaluates the expression in `dtype`.
+    """
+    constants = {}
+
+    def _replace(match):
+        if match.group(1):
+            return match.group(0)
+        name = f'c{len(constants)}'
+        constants[name] = dtype.type(match.group(2))
+        return name
+
+    return _NUMEXPR_LITERAL.sub(_replace, expression), constants
+
+
+def _dn_to_reflectance(dn, offset, dtype):
+    """
+    Convert a block of Sentinel-2 L2A digital numbers to surface
+    reflectance in `dtype`, as (DN + BOA_ADD_OFFSET) / 10000, setting
+    nodata (DN of 0) to NaN.
+    """
+    reflectance = np.add(dn, offset, dtype=dtype)
+    reflectance *= dtype.type(1 / 10000)
+    reflectance[dn == 0] = np.nan
+    return reflectance
+
+
+def _boa_offset(time):
+    """
+    Return the BOA_ADD_OFFSET of Sentinel-2 L2A images for each date in
+    `time`: -1000 for images produced from the 04.00 processing baseline
+    (i.e., since 25 January 2022) and 0 before.
+    """
+    return xr.where(time >= np.datetime64('2022-01-25'), -1000, 0)
+
+
+def _band_encoding(ds, bands):
+    """
+    Return the (scale_factor, nodata) attributes of `bands` if they hold
+    the compact integer output of `cleaning_s2(dtype='uint16')` (marked
+    with an 'encoded_by' attribute set to 'cleaning_s2'), or None for 
+    bands holding plain values, whatever other attributes they have 
+    (e.g. the scale_factor of 1 that rioxarray sets on raw bands).
+    """
+    encoded = [band for band in bands 
+               if ds[band].attrs.get('encoded_by') == 'cleaning_s2']
+    if not encoded:
+        return None
+    if len(encoded) < len(bands):
+        raise ValueError(f'Only the bands {encoded} of {bands} are encoded '
+                         f'by `cleaning_s2`; please provide bands cleaned '
+                         f'the same way.')
+    for band in bands:
+        attrs = ds[band].attrs
+        if (ds[band].dtype.kind not in 'ui' or 'scale_factor' not in attrs 
+                or 'nodata' not in attrs or attrs.get('add_offset', 0) != 0):
+            raise ValueError(f"The band '{band}' is marked as encoded by "
+                             f"`cleaning_s2` but is not an integer band with "
+                             f"'scale_factor' and 'nodata' attributes and no "
+                             f"'add_offset'.")
+    encodings = {(ds[band].attrs['scale_factor'], ds[band].attrs['nodata'])
+                 for band in bands}
+    if len(encodings) > 1:
+        raise ValueError(f'The bands {bands} mix different scale factors or '
+                         f'nodata values; please provide bands cleaned the '
+                         f'same way (e.g. all with `cleaning_s2`).')
+    return encodings.pop()
+
+
+def _valid_block(arrays, shape, block, from_dn, encoding=None):
+    """
+    Return a boolean mask of the pixels of `block` that are valid (not
+    NaN, or not nodata for Sentinel-2 digital numbers or bands with an
+    `encoding`) in every array of `arrays`, or None if no pixel can be
+    invalid.
+    """
+    valid = None
+    for array in arrays:
+        values = np.broadcast_to(array, shape)[block]
+        if encoding is not None and encoding[1] is not None:
+            band_valid = values != encoding[1]
+        elif from_dn:
+            band_valid = values != 0
+        elif values.dtype.kind == 'f':
+            band_valid = np.isfinite(values)
+        else:
+            continue
+        valid = band_valid if valid is None else valid & band_valid
+    return valid
+
+
+def _read_band_block(bands, arrays, shape, block, mult, dtype, from_dn,
+                     valid=None, encoding=None):
+    """
+    Read `block` of each band in `bands` from `arrays`, normalised and
+    converted to `dtype`, and return them as attributes of a namespace
+    (e.g. `band_block.nir`) for the index recipes. If a `valid` mask is
+    given, only the valid pixels are read, packed into 1-D arrays.
+
+    With `from_dn=True` the bands are Sentinel-2 digital numbers and
+    `arrays` holds the BOA offset of each pixel as an extra, final
+    array; each band is converted to reflectance with
+    `_dn_to_reflectance` instead of being divided by `mult`.
+
+    With an `encoding` (scale_factor, nodata), see `_band_encoding`, 
+    each band is first multiplied by its scale factor, and its nodata
+    pixels are set to NaN.
+    """
+    def _read(array):
+        values = np.broadcast_to(array, shape)[block]
+        return values if valid is None else values[valid]
+
+    if encoding is not None:
+        scale_factor, nodata = encoding
+        def _decode(values):
+            decoded = np.multiply(values, dtype.type(scale_factor / mult),
+                                  dtype=dtype)
+            if nodata is not None:
+                decoded[values == nodata] = np.nan
+            return decoded
+        return SimpleNamespace(**{band: _decode(_read(array))
+                                  for band, array in zip(bands, arrays)})
+
+    if from_dn:
+        offset = _read(arrays[-1])
+        return SimpleNamespace(**{
+            band: _dn_to_reflectance(_read(array), offset, dtype)
+            for band, array in zip(bands, arrays)})
+
+    return SimpleNamespace(**{
+        band: np.divide(_read(array), mult, dtype=dtype)
+        for band, array in zip(bands, arrays)})
+
+
+def _linear_block(weights, bias, band_arrays, outputs):
+    """
+    Write `weights @ bands + bias` into `outputs`, one output per row of
+    `weights`, by stacking the band blocks along a band axis once and
+    applying a single matrix multiply.
+    """
+    stack = np.stack([band.reshape(-1) for band in band_arrays])
+    result = weights @ stack
+    if bias is not None:
+        result += bias[:, np.newaxis]
+    for output, row in zip(outputs, result):
+        output[...] = row.reshape(output.shape)
+
+
+def _index_band_groups(indices, bands):
+    """
+    Group `indices` by the set of bands (among `bands`) they need, and 
+    return a list of (band positions in `bands`, indices) pairs, so that
+    the valid pixels of each group can be found from its own bands only.
+    """
+    groups = {}
+    for index in indices:
+        positions = tuple(i for i, band in enumerate(bands)
+                          if band in _INDEX_BANDS[index])
+        groups.setdefault(positions, []).append(index)
+    return list(groups.items())
+
+
+def _fused_index_func(indices, bands, mult, backend='numpy',
+                      dtype=np.float32, from_dn=False, valid_only=False,
+                      encoding=None):
+    """
+    Build a function that takes one array per band in `bands` and
+    returns one array per index in `indices`. Each band is read and
+    normalised once per block (converting it to `dtype` at the same
+    time), and every index is written from that block before moving on
+    to the next one, so the whole input is only scanned once however
+    many indices are requested.
+
+    With `from_dn=True` the function takes the BOA offset of each pixel
+    as an extra, final array (see `_read_band_block`). With an 
+    `encoding`, the bands are decoded as they are read.
+
+    With `backend='numpy'` each block is evaluated with the recipes in
+    `_INDEX_RECIPES`; with `backend='numexpr'` it is evaluated with the
+    compiled kernels for `_INDEX_EXPRESSIONS` (see `_numexpr_kernel`),
+    directly into the output, over blocks of `_NUMEXPR_BLOCK_SIZE`.
+    When several tasselled cap indices are requested, they are computed
+    together with one matrix multiply per block instead.
+
+    With `valid_only=True` the indices are grouped by the bands they 
+    need. The validity of each band (not NaN, or not nodata) is found
+    once per block, and combined for each group: a group with no valid
+    pixel in the block is set to NaN without being evaluated, and one
+    with fewer than `_VALID_ONLY_DENSITY` valid pixels only has its
+    valid pixels packed into 1-D arrays and passed to the recipes, the
+    results being scattered back into the block with every other pixel
+    set to NaN. Otherwise the whole block is evaluated, the invalid 
+    pixels giving NaN through the recipes. A band an index does not use
+    therefore never masks it.
+    """
+    block_size = _BLOCK_SIZE
+    if backend == 'numexpr':
+        import numexpr
+        block_size = _NUMEXPR_BLOCK_SIZE
+        kernels = {index: _numexpr_kernel(_INDEX_EXPRESSIONS[index], dtype)
+                   for index in indices}
+
+    if valid_only:
+        groups = _index_band_groups(indices, bands)
+    else:
+        groups = [(tuple(range(len(bands))), list(indices))]
+
+    tasselled_cap = [index for index in indices if index in _TASSELLED_CAP]
+    if len(tasselled_cap) < 2:
+        tasselled_cap = []
+    weights = np.array([_TASSELLED_CAP[index] for index in tasselled_cap],
+                       dtype=dtype)
+
+    def _func(*arrays):
+        shape = np.broadcast_shapes(*(np.shape(array) for array in arrays))
+        outputs = tuple(np.empty(shape, dtype=dtype) for _ in indices)
+
+        # Bands that can hold invalid pixels once read (NaN in floating
+        # point bands, nodata in digital numbers or encoded bands)
+        maskable = [from_dn or encoding is not None or
+                    np.asarray(array).dtype.kind == 'f'
+                    for array in arrays[:len(bands)]]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for block in _iter_blocks(shape, block_size):
+                band_block = _read_band_block(bands, arrays, shape, block,
+                                              mult, dtype, from_dn,
+                                              encoding=encoding)
+                band_valid = {}
+                if valid_only:
+                    for band, mask in zip(bands, maskable):
+                        if mask:
+                            valid = np.isfinite(getattr(band_block, band))
+                            if not valid.all():
+                                band_valid[band] = valid
+
+                for positions, group in groups:
+                    group_bands = [bands[i] for i in positions]
+                    group_outputs = [outputs[indices.index(index)]
+                                     for index in group]
+
+                    valid = None
+                    for band in group_bands:
+                        if band in band_valid:
+                            valid = (band_valid[band] if valid is None
+                                     else valid & band_valid[band])
+                    packed = False
+                    if valid is not None:
+                        n_valid = np.count_nonzero(valid)
+                        if n_valid == valid.size:
+                            valid = None
+                        elif n_valid == 0:
+                            for output in group_outputs:
+                                output[block] = np.nan
+                            continue
+                        else:
+                            packed = n_valid < _VALID_ONLY_DENSITY * valid.size
+
+                    group_block = band_block
+                    if packed:
+                        # Index arrays are much faster than boolean masks
+                        # to gather and scatter the valid pixels with
+                        pixels = np.flatnonzero(valid)
+                        group_block = SimpleNamespace(**{
+                            band: getattr(band_block, band).take(pixels)
+                            for band in group_bands})
+                        block_outputs = [np.empty(n_valid, dtype=dtype)
+                                         for _ in group]
+                    else:
+                        block_outputs = [output[block]
+                                         for output in group_outputs]
+
+                    group_tasselled_cap = [index for index in tasselled_cap
+                                           if index in group]
+                    if group_tasselled_cap:
+                        _linear_block(
+                            weights[[tasselled_cap.index(index)
+                                     for index in group_tasselled_cap]], None,
+                            [getattr(group_block, band)
+                             for band in _TASSELLED_CAP_BANDS],
+                            [block_outputs[group.index(index)]
+                             for index in group_tasselled_cap])
+                    for block_output, index in zip(block_outputs, group):
+                        if index in group_tasselled_cap:
+                            continue
+                        elif backend == 'numexpr':
+                            expression, constants = kernels[index]
+                            numexpr.evaluate(expression,
+                                             local_dict={**vars(group_block),
+                                                         **constants},
+                                             out=block_output,
+                                             casting='same_kind')
+                        else:
+                            block_output[...] = _INDEX_RECIPES[index](group_block)
+
+                    if packed:
+                        for output, block_output in zip(group_outputs,
+                                                        block_outputs):
+                            output[block] = np.nan
+                            output[block].put(pixels, block_output)
+
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    return _func
+
+
+def _check_index(index):
+    """
+    Raise an exception if no index is provided or if an invalid option 
+    is provided, informing user to choose from the list of valid options.
+    """
+    if index is None:
+
+        raise ValueError(f"No remote sensing `index` was provided. Please "
+                          "refer to the function \ndocumentation for a full "
+                          "list of valid options for `index` (e.g. 'NDVI')")
+
+    elif str(index) not in _INDEX_RECIPES:
+
+        raise ValueError(f"The selected index '{index}' is not one of the "
+                          "valid remote sensing index options. \nPlease "
+                          "refer to the function documentation for a full "
+                          "list of valid options for `index`")
+
+
+def _check_platform(platform):
+    """
+    Raise an exception if no platform, or a platform not available in 
+    this data cube, is provided.
+    """
+    if platform is None:
+
+        raise ValueError("'No `platform` was provided. Please specify "
+                         "either 'SENTINEL_2', 'LANDSAT_8', 'LANDSAT_7', or 'LANDSAT_5' \nto "
+                         "ensure the function calculates indices using the "
+                         "correct spectral bands")
+
+    elif platform in ['LANDSAT_8', 'LANDSAT_7', 'LANDSAT_5']:
+
+        # These platforms are currently not available (TO DEV)
+        raise ValueError(f"'{platform}' is currently not available "
+                          "in this data cube. Please use \n"
+                          "'SENTINEL_2' platform")
+
+    # Raise error if no valid platform name is provided:
+    elif platform != 'SENTINEL_2':
+        raise ValueError(f"'{platform}' is not a valid option for "
+                          "`platform`. Please specify either \n"
+                          "either 'SENTINEL_2', 'LANDSAT_8', 'LANDSAT_7', or 'LANDSAT_5'")
+
 
 # Define custom functions
 def calculate_indices(ds,
@@ -28,6 +744,11 @@ def calculate_indices(ds,
                       custom_varname=None,
                       normalise=False,
                       drop=False,
+                      inplace=False,
+                      backend='numpy',
+                      dtype='float32',
+                      from_dn=False,
+                      valid_only=False,
                       quiet=False):
     """
     Takes an xarray dataset containing spectral bands, calculates one of
@@ -36,7 +757,7 @@ def calculate_indices(ds,
     
     Note: by default, this function will create a new copy of the data
     in memory. This can be a memory-expensive operation, so to avoid
-    this, set `inplace=True`.
+    this, set `inplace=True` or `drop=True`.
     Last modified: March 2021
     
     Parameters
@@ -120,231 +841,84 @@ def calculate_indices(ds,
     drop : bool, optional
         Provides the option to drop the original input data, thus saving 
         space. if drop = True, returns only the index and its values.
+        The input bands are never copied in this mode.
+    inplace : bool, optional
+        If `inplace=True`, the index variable/s are added directly to
+        the input dataset instead of to a copy of it, so the input bands
+        are never duplicated in memory. Defaults to False.
+    backend : str, optional
+        The kernel used to evaluate each index. 'numpy' (the default)
+        applies the index formulas with numpy operators, on blocks small
+        enough for their temporaries to stay in cache. 'numexpr'
+        evaluates each index with a compiled numexpr kernel (compiled
+        once per index and data type and reused across calls), which
+        can spread each block over several threads. On a single core
+        it is slower than 'numpy', so only use it on a machine with
+        several cores where `wdc_benchmarks.benchmark_backends` shows
+        it pays off. Requires the `numexpr` package.
+    dtype : str or numpy dtype, optional
+        The floating point data type used to normalise the input bands,
+        to evaluate every index and for the returned index variable/s.
+        Defaults to 'float32', which halves memory use and bandwidth
+        compared with 'float64' and is ample for surface reflectance.
+    from_dn : bool, optional
+        Set `from_dn=True` when `ds` holds Sentinel-2 L2A digital numbers
+        loaded straight from the data cube (e.g. uint16 bands that have
+        not been through `cleaning_s2`). Indices are then computed
+        directly from the integer bands: each block of a required band
+        is converted to reflectance as (DN + BOA_ADD_OFFSET) / 10000 on
+        the fly, applying the -1000 offset of images produced since 25
+        January 2022, and pixels with a DN of 0 (nodata) are set to NaN.
+        No full-size floating point copy of the bands is ever made and
+        `normalise` is ignored. Defaults to False.
+        Bands returned by `cleaning_s2(dtype='uint16')` (integer bands 
+        marked with an 'encoded_by' attribute set to 'cleaning_s2') do
+        not need this option: they are recognised from that attribute 
+        and decoded with their 'scale_factor' and 'nodata' ones as 
+        they are read (pixels equal to 'nodata' set to NaN) and give the
+        same indices as the floating point output of `cleaning_s2`, 
+        with the same `normalise` option (except where the offset made
+        a band negative, which the compact output clips). Setting `from_dn=True` on them
+        raises an error, as their BOA offset is already applied.
+    valid_only : bool, optional
+        If `valid_only=True`, each index is only computed for the pixels
+        that are valid in every band that index needs (not NaN, e.g. 
+        after cloud masking with `cleaning_s2`, or not 0 with 
+        `from_dn=True`); bands used by other indices only are ignored.
+        Blocks of pixels without any valid pixel are skipped and, in 
+        blocks with few valid pixels, those are packed together, the 
+        indices computed on them and the results scattered back, with 
+        every other pixel set to NaN. The results are the same. This 
+        only pays off on almost entirely cloudy data (e.g. about 1.2x 
+        faster at 90-95% cloud cover, and slower at 50%), so check it 
+        on your data with `wdc_benchmarks.benchmark_valid_only`. 
+        Defaults to False.
         
     Returns
     -------
     ds : xarray Dataset
         The original xarray Dataset inputted into the function, with a 
         new varible containing the remote sensing index as a DataArray.
-        If drop = True, the new variable/s as DataArrays in the 
-        original Dataset.
+        If drop = True, a new Dataset containing only the new 
+        variable/s as DataArrays. If inplace = True, the input Dataset
+        itself.
     """
     
-    # Set ds equal to a copy of itself in order to prevent the function 
-    # from editing the input dataset. This can prevent unexpected
-    # behaviour though it uses twice as much memory.    
-    ds = ds.copy(deep=True)
-    
     # Capture input band names in order to drop these if drop=True
     if drop:
         bands_to_drop=list(ds.data_vars)
-        print(f'Dropping bands {bands_to_drop}')
-    
-    # Dictionary containing remote sensing index band recipes
-    index_dict = {
-                  # Normalised Difference Vegation Index, Rouse 1973
-                  'NDVI': lambda ds: (ds.nir - ds.red) /
-                                     (ds.nir + ds.red),
-        
-                  # Green Normalised Difference Vegetation Index, Gitelson and Merzlyak 1998
-                  'GNDVI': lambda ds: (ds.nir - ds.green) /
-                                     (ds.nir + ds.green),
-
-                  # Non-linear Normalised Difference Vegation Index,
-                  # Camps-Valls et al. 2021
-                  'kNDVI': lambda ds: np.tanh(((ds.nir - ds.red) /
-                                               (ds.nir + ds.red)) ** 2),
-
-                  # Enhanced Vegetation Index, Huete 2002
-                  'EVI': lambda ds: ((2.5 * (ds.nir - ds.red)) /
-                                     (ds.nir + 6 * ds.red -
-                                      7.5 * ds.blue + 1)),
-
-                  # Leaf Area Index, Boegh 2002
-                  'LAI': lambda ds: (3.618 * ((2.5 * (ds.nir - ds.red)) /
-                                     (ds.nir + 6 * ds.red -
-                                      7.5 * ds.blue + 1)) - 0.118),
-
-                  # Soil Adjusted Vegetation Index, Huete 1988
-                  'SAVI': lambda ds: ((1.5 * (ds.nir - ds.red)) /
-                                      (ds.nir + ds.red + 0.5)),
-      
-                  # Mod. Soil Adjusted Vegetation Index, Qi et al. 1994
-                  'MSAVI': lambda ds: ((2 * ds.nir + 1 - 
-                                      ((2 * ds.nir + 1)**2 - 
-                                       8 * (ds.nir - ds.red))**0.5) / 2),
-
-                  # Wide Dynamic Range Vegetation Index, Peng and Gitelson 2011
-                  'WDRVI': lambda ds: ((0.2 * ds.nir - ds.red) /
-                                        (0.2 * ds.nir + ds.red) +
-                                        (1 - 0.2)/(1 + 0.2)),
-
-                  # Vegetation Index Green, Gitelson et al. 2002
-                  'VARIg': lambda ds: ((ds.green - ds.red) /
-                                        (ds.green + ds.red - ds.blue)),
-
-                  # Inverted Red-Edge Chlorophyll Index, Clevers et al., 2000
-                  'IRECI': lambda ds: ((ds.veg7 - ds.red) /
-                                        (ds.veg5 / ds.veg6)),
-
-                  # Chlorophyll Index - red edge, Gitelson et al. 2005
-                  'CIre': lambda ds: ((ds.veg7 / ds.veg5) - 1),
-
-                  # Chlorophyll Index - green, Gitelson et al. 2005
-                  'CIg': lambda ds: ((ds.veg7 / ds.green) - 1),
-                  
-                  # Modified Chlorophyll Absorption in Reflectance Index 2, Haboudane et al. 2004
-                  'MCARI2': lambda ds: (1.5 * (2.5 * (ds.veg7 - ds.red) -
-                                        1.3 * (ds.veg7 - ds.green)) /
-                                        math.sqrt(((2.0 * ds.veg7 + 1.0) ** 2.0) -
-                                        (6.0 * ds.veg7 - 5.0 * math.sqrt(ds.red)) -
-                                        0.5)),
-
-                  # Plant Senescence Reflectance Index, Merzlyak et al. 1999
-                  'PSRI': lambda ds: ((ds.red - ds.blue) / ds.veg6),
-
-                  # Sentinel2 Red Edge Position
-                  'S2REP': lambda ds: (705 + 35*((ds.red + ds.veg7) / 2 - ds.veg5 ) /
-                                      (ds.veg6 - ds.veg5)),
-                  
-                  # Anthocyanin reflectance index, Gitelson et al. 2009
-                  'ARI': lambda ds: ( (1 / ds.green) - (1 / ds.veg5)),
-
-                  #Moisture Stress Index, 
-                  'MSI': lambda ds: (ds.swir1 / ds.nir),
-
-                  # Normalised Difference Moisture Index, Gao 1996
-                  'NDMI': lambda ds: (ds.nir - ds.swir1) /
-                                     (ds.nir + ds.swir1),
-
-                  # Normalised Burn Ratio, Lopez Garcia 1991
-                  'NBR': lambda ds: (ds.nir - ds.swir2) /
-                                    (ds.nir + ds.swir2),
-
-                  # Burn Area Index, Martin 1998
-                  'BAI': lambda ds: (1.0 / ((0.10 - ds.red) ** 2 +
-                                            (0.06 - ds.nir) ** 2)),
-        
-                 # Normalised Difference Chlorophyll Index, Mishra & Mishra, 2012
-                  'NDCI': lambda ds: (ds.veg5 - ds.red) /
-                                     (ds.veg5 + ds.red),
-
-                  # Normalised Difference Snow Index, Hall 1995
-                  'NDSI': lambda ds: (ds.green - ds.swir1) /
-                                     (ds.green + ds.swir1),
-
-                  # Normalised Difference Tillage Index,
-                  # Van Deventer et al. 1997
-                  'NDTI': lambda ds: (ds.swir1 - ds.swir2) /
-                                     (ds.swir1 + ds.swir2),
-
-                  # Normalised Difference Water Index, McFeeters 1996
-                  'NDWI': lambda ds: (ds.green - ds.nir) /
-                                     (ds.green + ds.nir),
-
-                  # Modified Normalised Difference Water Index, Xu 2006
-                  'MNDWI': lambda ds: (ds.green - ds.swir1) /
-                                      (ds.green + ds.swir1),
-      
-                  # Normalised Difference Built-Up Index, Zha 2003
-                  'NDBI': lambda ds: (ds.swir1 - ds.nir) /
-                                     (ds.swir1 + ds.nir),
-      
-                  # Built-Up Index, He et al. 2010
-                  'BUI': lambda ds:  ((ds.swir1 - ds.nir) /
-                                      (ds.swir1 + ds.nir)) -
-                                     ((ds.nir - ds.red) /
-                                      (ds.nir + ds.red)),
-      
-                  # Built-up Area Extraction Index, Bouzekri et al. 2015
-                  'BAEI': lambda ds: (ds.red + 0.3) /
-                                     (ds.green + ds.swir1),
-      
-                  # New Built-up Index, Jieli et al. 2010
-                  'NBI': lambda ds: (ds.swir1 + ds.red) / ds.nir,
-      
-                  # Bare Soil Index, Rikimaru et al. 2002
-                  'BSI': lambda ds: ((ds.swir1 + ds.red) - 
-                                     (ds.nir + ds.blue)) / 
-                                    ((ds.swir1 + ds.red) + 
-                                     (ds.nir + ds.blue)),
-
-                  # Automated Water Extraction Index (no shadows), Feyisa 2014
-                  'AWEI_ns': lambda ds: (4 * (ds.green - ds.swir1) -
-                                        (0.25 * ds.nir * + 2.75 * ds.swir2)),
-
-                  # Automated Water Extraction Index (shadows), Feyisa 2014
-                  'AWEI_sh': lambda ds: (ds.blue + 2.5 * ds.green -
-                                         1.5 * (ds.nir + ds.swir1) -
-                                         0.25 * ds.swir2),
-
-                  # Water Index, Fisher 2016
-                  'WI': lambda ds: (1.7204 + 171 * ds.green + 3 * ds.red -
-                                    70 * ds.nir - 45 * ds.swir1 -
-                                    71 * ds.swir2),
-
-                  # Tasseled Cap Wetness, Crist 1985
-                  'TCW': lambda ds: (0.0315 * ds.blue + 0.2021 * ds.green +
-                                     0.3102 * ds.red + 0.1594 * ds.nir +
-                                    -0.6806 * ds.swir1 + -0.6109 * ds.swir2),
-
-                  # Tasseled Cap Greeness, Crist 1985
-                  'TCG': lambda ds: (-0.1603 * ds.blue + -0.2819 * ds.green +
-                                     -0.4934 * ds.red + 0.7940 * ds.nir +
-                                     -0.0002 * ds.swir1 + -0.1446 * ds.swir2),
-
-                  # Tasseled Cap Brightness, Crist 1985
-                  'TCB': lambda ds: (0.2043 * ds.blue + 0.4158 * ds.green +
-                                     0.5524 * ds.red + 0.5741 * ds.nir +
-                                     0.3124 * ds.swir1 + -0.2303 * ds.swir2),
-                  
-                  # Tasseled Cap Transformations with Sentinel-2 coefficients 
-                  # after Nedkov 2017 using Gram-Schmidt orthogonalization (GSO)
-                  # Tasseled Cap Wetness, Nedkov 2017
-                  'TCW_GSO': lambda ds: (0.0649 * ds.blue + 0.2802 * ds.green +
-                                         0.3072 * ds.red + -0.0807 * ds.nir +
-                                        -0.4064 * ds.swir1 + -0.5602 * ds.swir2),
-
-                  # Tasseled Cap Greeness, Nedkov 2017
-                  'TCG_GSO': lambda ds: (-0.0635 * ds.blue + -0.168 * ds.green +
-                                         -0.348 * ds.red + 0.3895 * ds.nir +
-                                         -0.4587 * ds.swir1 + -0.4064 * ds.swir2),
-
-                  # Tasseled Cap Brightness, Nedkov 2017
-                  'TCB_GSO': lambda ds: (0.0822 * ds.blue + 0.136 * ds.green +
-                                         0.2611 * ds.red + 0.5741 * ds.nir +
-                                         0.3882 * ds.swir1 + 0.1366 * ds.swir2),
-
-                  # Clay Minerals Ratio, Drury 1987
-                  'CMR': lambda ds: (ds.swir1 / ds.swir2),
-
-                  # Ferrous Minerals Ratio, Segal 1982
-                  'FMR': lambda ds: (ds.swir1 / ds.nir),
-
-                  # Iron Oxide Ratio, Segal 1982
-                  'IOR': lambda ds: (ds.red / ds.blue)
-    }
+        if not quiet:
+            print(f'Dropping bands {bands_to_drop}')
     
     # If index supplied is not a list, convert to list. This allows us to
     # iterate through either multiple or single indices in the loop below
     indices = index if isinstance(index, list) else [index]
     
-    #calculate for each index in the list of indices supplied (indexes)
+    # Check every index supplied (indexes) before computing any of them
     for index in indices:
+        _check_index(index)
 
-        # Select an index function from the dictionary
-        index_func = index_dict.get(str(index))
-
-        # If no index is provided or if no function is returned due to an 
-        # invalid option being provided, raise an exception informing user to 
-        # choose from the list of valid options
-        if index is None:
-
-            raise ValueError(f"No remote sensing `index` was provided. Please "
-                              "refer to the function \ndocumentation for a full "
-                              "list of valid options for `index` (e.g. 'NDVI')")
-
-        elif not normalise:
+        if not (normalise or from_dn):
             if not quiet:
 
                 print(f"\nWarning: The index ('{index}') normally "
@@ -353,71 +927,498 @@ def calculate_indices(ds,
                         "reflectance can produce unexpected results; \nif "
                         "required, resolve this by setting `normalise=True`")
 
-        elif index_func is None:
+    _check_platform(platform)
+
+    if backend not in ['numpy', 'numexpr']:
+        raise ValueError(f"'{backend}' is not a valid option for "
+                          "`backend`. Please specify either 'numpy' "
+                          "or 'numexpr'")
 
-            raise ValueError(f"The selected index '{index}' is not one of the "
-                              "valid remote sensing index options. \nPlease "
-                              "refer to the function documentation for a full "
-                              "list of valid options for `index`")
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f':
+        raise ValueError(f"'{dtype}' is not a valid option for `dtype`. "
+                          "Please specify a floating point data type, "
+                          "e.g. 'float32' or 'float64'")
+
+    # Work out the bands needed by all requested indices, so that each one
+    # is read and normalised only once
+    bands = []
+    for index in indices:
+        missing = [band for band in _INDEX_BANDS[index] if band not in ds]
+        if missing:
+            raise ValueError(f'Please verify that all bands required to '
+                             f'compute {index} are present in `ds`. \n'
+                             f'These bands may vary depending on the `platform` '
+                             f'(e.g. the band `veg6` from Sentinel 2 does not \n'
+                             f'have equivelent for Landsat 8')
+        bands += [band for band in _INDEX_BANDS[index] if band not in bands]
 
-        if platform is None:
+    # Compact bands from `cleaning_s2(dtype='uint16')` are decoded with
+    # their scale factor and nodata attributes as they are read
+    encoding = _band_encoding(ds, bands)
+    if encoding is not None and from_dn:
+        raise ValueError(f'The bands of `ds` are the compact output of '
+                         f'`cleaning_s2`, which already has the BOA offset '
+                         f'applied; please do not set `from_dn=True`.')
 
-            raise ValueError("'No `platform` was provided. Please specify "
-                             "either 'SENTINEL_2', 'LANDSAT_8', 'LANDSAT_7', or 'LANDSAT_5' \nto "
-                             "ensure the function calculates indices using the "
-                             "correct spectral bands")
+    # Apply all index functions in a single pass over the input bands. 
+    # If normalised=True, divide data by 10,000 before applying funcs. If
+    # from_dn=True, pass the BOA offset of each date along with the bands
+    mult = 10000.0 if normalise else 1.0
+    inputs = [ds[band] for band in bands]
+    if from_dn:
+        inputs.append(_boa_offset(ds.time) if 'time' in ds.coords else 0)
+    index_arrays = xr.apply_ufunc(_fused_index_func(indices, bands, mult,
+                                                    backend, dtype, from_dn,
+                                                    valid_only, encoding),
+                                  *inputs,
+                                  output_core_dims=[[]] * len(indices),
+                                  dask='parallelized',
+                                  output_dtypes=[dtype] * len(indices))
+    if len(indices) == 1:
+        index_arrays = (index_arrays,)
 
-        elif platform == 'LANDSAT_8':
+    output_band_names = [custom_varname if custom_varname else index
+                         for index in indices]
 
-            # This platform is currently not available (TO DEV)
-            raise ValueError(f"'{platform}' is currently not available "
-                              "in this data cube. Please use \n"
-                              "'SENTINEL_2' platform")
+    # If drop=True, build a new dataset from the indices alone so the
+    # input bands are never copied
+    if drop:
+        return xr.Dataset(dict(zip(output_band_names, index_arrays)),
+                          attrs=ds.attrs)
 
-        elif platform == 'LANDSAT_7':
+    # Otherwise set ds equal to a copy of itself in order to prevent the
+    # function from editing the input dataset. This can prevent unexpected
+    # behaviour though it uses twice as much memory; set inplace=True to
+    # avoid this.
+    if not inplace:
+        ds = ds.copy(deep=True)
 
-            # This platform is currently not available (TO DEV)
-            raise ValueError(f"'{platform}' is currently not available "
-                              "in this data cube. Please use \n"
-                              "'SENTINEL_2' platform")
+    # Add as new variables in dataset
+    for output_band_name, index_array in zip(output_band_names, index_arrays):
+        ds[output_band_name] = index_array
+    
+    # Return input dataset with added index variable
+    return ds
 
-        elif platform == 'LANDSAT_5':
 
-            # This platform is currently not available (TO DEV)
-            raise ValueError(f"'{platform}' is currently not available "
-                              "in this data cube. Please use \n"
-                              "'SENTINEL_2' platform")
+def index_measurements(index=None, platform=None, cloud_mask=True):
+    """
+    Takes the name of one or more remote sensing indices and returns the
+    minimal list of measurements to load from the data cube in order to
+    calculate them with `calculate_indices`. Loading only these bands,
+    rather than every band of the product, avoids reading data that
+    would never be used (e.g. 3 out of 10 bands for NDVI with the cloud
+    mask).
+    
+    Parameters
+    ----------
+    index : str or list of strs
+        The name/s of the indices to calculate. See `calculate_indices`
+        for a full list of valid options.
+    platform : str
+        The data platform the indices will be calculated on. Valid 
+        options are 'SENTINEL_2'.
+    cloud_mask : bool, optional
+        If True (the default), the 'scl' cloud mask band is added to the
+        measurements so the data can be cleaned with `cleaning_s2`.
         
-        elif platform == 'SENTINEL_2':
+    Returns
+    -------
+    measurements : list of str
+        The band names, in the order of the Sentinel-2 bands.
+    """
+    indices = index if isinstance(index, list) else [index]
+    for index in indices:
+        _check_index(index)
+    _check_platform(platform)
+    
+    required = set()
+    for index in indices:
+        required.update(_INDEX_BANDS[index])
+    
+    band_order = ['blue', 'green', 'red', 'veg5', 'veg6', 'veg7',
+                  'nir', 'swir1', 'swir2']
+    measurements = [band for band in band_order if band in required]
+    if cloud_mask:
+        measurements.append('scl')
+    return measurements
 
-            # valid
-            valid =1
 
-        # Raise error if no valid platform name is provided:
-        else:
-            raise ValueError(f"'{platform}' is not a valid option for "
-                              "`platform`. Please specify either \n"
-                              "either 'SENTINEL_2', 'LANDSAT_8', 'LANDSAT_7', or 'LANDSAT_5'")
-
-        # Apply index function 
-        try:
-            # If normalised=True, divide data by 10,000 before applying func
-            mult = 10000.0 if normalise else 1.0
-            index_array = index_func(ds/mult)
-        except AttributeError:
-            raise ValueError(f'Please verify that all bands required to '
-                             f'compute {index} are present in `ds`. \n'
-                             f'These bands may vary depending on the `platform` '
-                             f'(e.g. the band `veg6` from Sentinel 2 does not \n'
-                             f'have equivelent for Landsat 8')
+def index_query(query, index=None, platform=None, cloud_mask=True):
+    """
+    Takes a datacube load query dictionary (e.g. as returned by the 
+    `query_site_period` functions) and returns a copy of it that only 
+    loads the measurements needed to calculate `index`. 
+    
+    Parameters
+    ----------
+    query : dict
+        Query for `dc.load`, e.g. with 'product', 'x', 'y', 'time', 
+        'output_crs' and 'resolution' keys. Any 'measurements' key is 
+        replaced.
+    index, platform, cloud_mask : 
+        See `index_measurements`.
+        
+    Returns
+    -------
+    query : dict
+        A new query dictionary to be used as `dc.load(**query)`.
+    """
+    query = dict(query)
+    query['measurements'] = index_measurements(index, platform, cloud_mask)
+    return query
 
-        # Add as a new variable in dataset
-        output_band_name = custom_varname if custom_varname else index
-        ds[output_band_name] = index_array
 
-    # Once all indexes are calculated, drop input bands if inplace=False
-    if drop:
-        ds = ds.drop(bands_to_drop)
+def calculate_indices_to_file(ds,
+                              filename,
+                              index=None,
+                              platform=None,
+                              tile_size=1024,
+                              n_workers=None,
+                              **kwargs):
+    """
+    Calculates one or more remote sensing indices tile by tile and 
+    writes each tile straight to a tiled GeoTIFF or a Zarr store, so 
+    that indices can be computed over extents too large to hold in 
+    memory. Tiles are processed in parallel, and peak memory is bounded 
+    by `n_workers` tiles of the input bands and their indices. 
     
-    # Return input dataset with added index variable
-    return ds
\ No newline at end of file
+    For this to hold, `ds` should be lazily loaded (e.g. with 
+    `dask_chunks` in `dc.load`); tiles are then only read when they 
+    are processed.
+    
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Dataset containing the spectral bands, with y/x or 
+        latitude/longitude dimensions and optionally a time dimension.
+    filename : str
+        The output file. Filenames ending in '.zarr' are written as a 
+        Zarr store (one variable per index); filenames ending in '.tif'
+        or '.tiff' as a tiled, compressed GeoTIFF with one band per 
+        index and time step.
+    index, platform : 
+        See `calculate_indices`.
+    tile_size : int, optional
+        Size of the square tiles in pixels. Also used as the chunk size 
+        of the Zarr store, and must then be a multiple of 16 for GeoTIFF
+        internal tiling. Defaults to 1024.
+    n_workers : int, optional
+        Number of tiles processed in parallel. Defaults to the number of
+        CPUs.
+    **kwargs : 
+        Other options of `calculate_indices` (e.g. `normalise=True`, 
+        `dtype`, `backend` or `from_dn`).
+    """
+    import os
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from wdc_datahandling import spatial_dims, tile_windows
+
+    for option in ['drop', 'inplace', 'quiet']:
+        kwargs.pop(option, None)
+    ydim, xdim = spatial_dims(ds)
+    tiles = tile_windows(ds.sizes[ydim], ds.sizes[xdim], tile_size)
+    
+    def _compute(tile):
+        ds_tile = ds.isel({ydim: tile[0], xdim: tile[1]})
+        return calculate_indices(ds_tile, index=index, platform=platform,
+                                 drop=True, quiet=True, 
+                                 **kwargs).load(scheduler='synchronous')
+    
+    # Calculate the indices for a single pixel to find out the names, 
+    # dimensions and data types of the outputs
+    sample = _compute((slice(0, 1), slice(0, 1)))
+    
+    if filename.endswith('.zarr'):
+        import dask.array
+        
+        template = xr.Dataset(
+            {name: (sample[name].dims,
+                    dask.array.empty(
+                        [ds.sizes[dim] for dim in sample[name].dims],
+                        chunks=[tile_size if dim in [ydim, xdim] else 1
+                                for dim in sample[name].dims],
+                        dtype=sample[name].dtype))
+             for name in sample.data_vars},
+            coords={name: coord for name, coord in ds.coords.items()
+                    if set(coord.dims).issubset(sample.dims)},
+            attrs=ds.attrs)
+        template.to_zarr(filename, mode='w', compute=False)
+        
+        def _write(tile, result):
+            result = result.drop_vars(
+                [name for name in result.variables
+                 if not {ydim, xdim}.issubset(result[name].dims)
+                 and name not in [ydim, xdim]])
+            result.to_zarr(filename, region={ydim: tile[0], xdim: tile[1]})
+        
+    elif filename.endswith(('.tif', '.tiff')):
+        import rasterio
+        import rioxarray
+        
+        layers = []
+        for name in sample.data_vars:
+            extra_dims = [dim for dim in sample[name].dims 
+                          if dim not in [ydim, xdim]]
+            if len(extra_dims) > 1:
+                raise ValueError(f'Only indices with a single non-spatial '
+                                 f'dimension can be exported to GeoTIFF; '
+                                 f'{name} has dimensions {sample[name].dims}')
+            if extra_dims:
+                layers += [(name, {extra_dims[0]: i}, 
+                            f'{name}_{str(value)[:10]}')
+                           for i, value in enumerate(
+                               ds[extra_dims[0]].values)]
+            else:
+                layers.append((name, {}, name))
+        
+        profile = {'driver': 'GTiff',
+                   'height': ds.sizes[ydim],
+                   'width': ds.sizes[xdim],
+                   'count': len(layers),
+                   'dtype': sample[list(sample.data_vars)[0]].dtype.name,
+                   'nodata': np.nan,
+                   'crs': ds.rio.crs,
+                   'transform': ds.rio.transform(),
+                   'tiled': True,
+                   'blockxsize': min(tile_size, 512),
+                   'blockysize': min(tile_size, 512),
+                   'compress': 'deflate',
+                   'BIGTIFF': 'IF_SAFER'}
+        dst = rasterio.open(filename, 'w', **profile)
+        for band, (_, _, description) in enumerate(layers, start=1):
+            dst.set_band_description(band, description)
+        lock = threading.Lock()
+        
+        def _write(tile, result):
+            window = rasterio.windows.Window(
+                tile[1].start, tile[0].start,
+                tile[1].stop - tile[1].start, tile[0].stop - tile[0].start)
+            data = np.stack([result[name][position].transpose(ydim, xdim)
+                             .values for name, position, _ in layers])
+            with lock:
+                dst.write(data, window=window)
+    
+    else:
+        raise ValueError(f"'{filename}' is not a valid `filename`. Please "
+                          "use a filename ending in '.zarr', '.tif' or "
+                          "'.tiff'")
+    
+    def _process(tile):
+        _write(tile, _compute(tile))
+    
+    print(f'Writing {len(tiles)} tiles to {filename}')
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()
+                                ) as executor:
+            list(executor.map(_process, tiles))
+    finally:
+        if not filename.endswith('.zarr'):
+            dst.close()
+    print(f'Indices exported to {filename}')
+
+
+def calculate_indices_sparse(ds, index=None, platform=None, **kwargs):
+    """
+    Calculates one or more remote sensing indices for the valid pixels
+    of `ds` only (see `valid_only` in `calculate_indices`) and returns 
+    them in a compact form: a Dataset with a single 'pixel' dimension 
+    holding one entry per pixel that is valid for at least one of the 
+    indices, with the coordinates (e.g. time, y and x) of each pixel as
+    coordinates along 'pixel'. An index is NaN at the pixels that are 
+    not valid in the bands it needs. On mostly cloudy data this is much
+    smaller than the full-size indices. 
+    
+    The full-size indices can be recovered with
+    `sparse.set_index(pixel=list(ds.dims)).unstack('pixel')`.
+    
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Dataset containing the spectral bands. The bands needed by the
+        indices are loaded in memory.
+    index, platform : 
+        See `calculate_indices`.
+    **kwargs : 
+        Other options of `calculate_indices` (e.g. `normalise=True`, 
+        `dtype`, `backend` or `from_dn`).
+        
+    Returns
+    -------
+    ds : xarray Dataset
+        The indices of the valid pixels, along a 'pixel' dimension.
+    """
+    for option in ['drop', 'inplace', 'valid_only']:
+        kwargs.pop(option, None)
+    from_dn = kwargs.get('from_dn', False)
+    indices = index if isinstance(index, list) else [index]
+    for index in indices:
+        _check_index(index)
+    
+    bands = []
+    for index in indices:
+        bands += [band for band in _INDEX_BANDS[index] 
+                  if band not in bands and band in ds]
+    dims = ds[bands[0]].dims
+    arrays = [ds[band].transpose(*dims).values for band in bands]
+    encoding = _band_encoding(ds, bands)
+    
+    # Find the pixels valid for at least one index (i.e. in every band of
+    # that index) and pack them into 1-D arrays
+    shape = arrays[0].shape
+    valid = np.zeros(shape, dtype=bool)
+    for positions, _ in _index_band_groups(indices, bands):
+        group_valid = _valid_block([arrays[i] for i in positions], shape, (),
+                                   from_dn, encoding)
+        if group_valid is None:
+            valid[...] = True
+            break
+        valid |= group_valid
+    pixels = np.flatnonzero(valid)
+    positions = np.unravel_index(pixels, shape)
+    
+    compact = xr.Dataset(
+        {band: ('pixel', array.reshape(-1)[pixels], ds[band].attrs) 
+         for band, array in zip(bands, arrays)},
+        coords={dim: ('pixel', ds[dim].values[position])
+                for dim, position in zip(dims, positions) if dim in ds.coords})
+    
+    # Pixels kept for one index may not be valid for another one, which
+    # is then set to NaN there
+    return calculate_indices(compact, index=indices, platform=platform, 
+                             drop=True, valid_only=True, **kwargs)
+
+
+def linear_band_transform(ds,
+                          coefficients,
+                          offsets=None,
+                          normalise=False,
+                          dtype='float32',
+                          from_dn=False):
+    """
+    Takes an xarray dataset containing spectral bands and applies a
+    linear transformation of the bands (e.g. a tasselled cap or a
+    principal components rotation), returning every transformed band
+    at once. The bands are stacked along a band axis block by block and
+    all outputs are computed with a single matrix multiply per block, so
+    each input band is only read once.
+    
+    Parameters
+    ----------
+    ds : xarray Dataset
+        A two-dimensional or multi-dimensional array containing the 
+        spectral bands used by the transformation.
+    coefficients : dict
+        The weights of the transformation, as a dictionary of 
+        {output name: {band name: weight}}, e.g. 
+        `{'TCB': {'blue': 0.2043, 'green': 0.4158, ...}, ...}`. Bands 
+        missing from an output's dictionary have a weight of zero.
+    offsets : dict, optional
+        Constants added to each output, as {output name: constant}.
+    normalise, dtype, from_dn : optional
+        See `calculate_indices`.
+        
+    Returns
+    -------
+    ds : xarray Dataset
+        A new Dataset with one variable per output of the 
+        transformation.
+    """
+    names = list(coefficients)
+    bands = []
+    for name in names:
+        bands += [band for band in coefficients[name] if band not in bands]
+    
+    missing = [band for band in bands if band not in ds]
+    if missing:
+        raise ValueError(f'Please verify that all bands required by the '
+                         f'transformation are present in `ds`. \n'
+                         f'Missing bands: {missing}')
+    
+    dtype = np.dtype(dtype)
+    weights = np.array([[coefficients[name].get(band, 0) for band in bands]
+                        for name in names], dtype=dtype)
+    bias = None
+    if offsets is not None:
+        bias = np.array([offsets.get(name, 0) for name in names],
+                        dtype=dtype)
+    mult = 10000.0 if normalise else 1.0
+    encoding = _band_encoding(ds, bands)
+    if encoding is not None and from_dn:
+        raise ValueError(f'The bands of `ds` are the compact output of '
+                         f'`cleaning_s2`, which already has the BOA offset '
+                         f'applied; please do not set `from_dn=True`.')
+    
+    def _func(*arrays):
+        shape = np.broadcast_shapes(*(np.shape(array) for array in arrays))
+        outputs = tuple(np.empty(shape, dtype=dtype) for _ in names)
+        
+        with np.errstate(invalid='ignore'):
+            for block in _iter_blocks(shape):
+                band_block = _read_band_block(bands, arrays, shape, block,
+                                              mult, dtype, from_dn,
+                                              encoding=encoding)
+                _linear_block(weights, bias,
+                              [getattr(band_block, band) for band in bands],
+                              [output[block] for output in outputs])
+        
+        return outputs if len(outputs) > 1 else outputs[0]
+    
+    inputs = [ds[band] for band in bands]
+    if from_dn:
+        inputs.append(_boa_offset(ds.time) if 'time' in ds.coords else 0)
+    outputs = xr.apply_ufunc(_func, *inputs,
+                             output_core_dims=[[]] * len(names),
+                             dask='parallelized',
+                             output_dtypes=[dtype] * len(names))
+    if len(names) == 1:
+        outputs = (outputs,)
+    
+    return xr.Dataset(dict(zip(names, outputs)), attrs=ds.attrs)
+
+
+def tasselled_cap(ds,
+                  coefficients='Crist',
+                  normalise=False,
+                  dtype='float32',
+                  from_dn=False):
+    """
+    Takes an xarray dataset containing the blue, green, red, nir, swir1 
+    and swir2 bands and returns the tasselled cap brightness, greenness
+    and wetness together, computed with `linear_band_transform`.
+    
+    Parameters
+    ----------
+    ds : xarray Dataset
+        A two-dimensional or multi-dimensional array containing the 
+        spectral bands.
+    coefficients : str, optional
+        'Crist' (the default) for the coefficients of Crist 1985, 
+        returned as 'TCB', 'TCG' and 'TCW', or 'GSO' for the Sentinel-2
+        coefficients of Nedkov 2017, returned as 'TCB_GSO', 'TCG_GSO'
+        and 'TCW_GSO'.
+    normalise, dtype, from_dn : optional
+        See `calculate_indices`.
+        
+    Returns
+    -------
+    ds : xarray Dataset
+        A new Dataset with the brightness, greenness and wetness 
+        variables.
+    """
+    if coefficients == 'Crist':
+        names = ['TCB', 'TCG', 'TCW']
+    elif coefficients == 'GSO':
+        names = ['TCB_GSO', 'TCG_GSO', 'TCW_GSO']
+    else:
+        raise ValueError(f"'{coefficients}' is not a valid option for "
+                          "`coefficients`. Please specify either 'Crist' "
+                          "or 'GSO'")
+    
+    return linear_band_transform(
+        ds,
+        {name: dict(zip(_TASSELLED_CAP_BANDS, _TASSELLED_CAP[name]))
+         for name in names},
+        normalise=normalise, dtype=dtype, from_dn=from_dn)
@@ -0,0 +1,394 @@
+## wdc_benchmarks.py
+
+'''
+Description: This file contains a set of python functions for measuring
+the run time and memory cost of the data cube utilities on synthetic
+satellite data.
+License: The code in this notebook is licensed under the Apache License,
+Version 2.0 (https://www.apache.org/licenses/LICENSE-2.0). Aberystwyth
+University data is licensed under the Creative Commons by Attribution 4.0
+license (https://creativecommons.org/licenses/by/4.0/).
+Contact: If you need assistance, please contact Richard Lucas or
+Carole Planque from Aberystwyth University.
+'''
+
+import timeit
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Index recipes that can be benchmarked. MCARI2 is left out as its recipe
+# only works on scalars (it uses `math.sqrt`).
+BENCHMARK_INDICES = ['NDVI', 'GNDVI', 'kNDVI', 'EVI', 'LAI', 'SAVI', 'MSAVI',
+                     'WDRVI', 'VARIg', 'IRECI', 'CIre', 'CIg', 'PSRI', 'S2REP',
+                     'ARI', 'MSI', 'NDMI', 'NBR', 'BAI', 'NDCI', 'NDSI', 'NDTI',
+                     'NDWI', 'MNDWI', 'NDBI', 'BUI', 'BAEI', 'NBI', 'BSI',
+                     'AWEI_ns', 'AWEI_sh', 'WI', 'TCW', 'TCG', 'TCB', 'TCW_GSO',
+                     'TCG_GSO', 'TCB_GSO', 'CMR', 'FMR', 'IOR']
+
+
+def synthetic_s2_dataset(time_steps=10, height=1000, width=1000,
+                         dask_chunks=None, seed=0):
+    """
+    Returns a synthetic Sentinel-2 L2A dataset with the band names used
+    in the data cube, filled with random uint16 digital numbers.
+
+    Parameters
+    ----------
+    time_steps : int, number of acquisitions. Default is 10.
+    height, width : int, number of pixels along y and x. Default is
+        1000 x 1000, i.e. a 10 x 10 km area at 10 m resolution.
+    dask_chunks : dict, optional. If provided, the dataset is chunked
+        with dask using e.g. {'time': 1, 'y': 500, 'x': 500}.
+    seed : int, seed of the random number generator. Default is 0.
+    """
+    rng = np.random.default_rng(seed)
+    bands = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2',
+             'veg5', 'veg6', 'veg7']
+    shape = (time_steps, height, width)
+
+    ds = xr.Dataset(
+        {band: (('time', 'y', 'x'),
+                rng.integers(1, 10000, shape, dtype=np.uint16))
+         for band in bands},
+        coords={'time': pd.date_range('2022-01-01', periods=time_steps,
+                                      freq='5D'),
+                'y': 300000 - 10 * np.arange(height) - 5,
+                'x': 250000 + 10 * np.arange(width) + 5})
+    ds['scl'] = (('time', 'y', 'x'),
+                 rng.choice(np.array([3, 4, 5, 6, 7, 8, 9, 11],
+                                     dtype=np.uint8), shape))
+
+    if dask_chunks is not None:
+        ds = ds.chunk(dask_chunks)
+    return ds
+
+
+def _measure(func, repeat=1):
+    """
+    Runs `func` (loading its result if it is lazy) and returns its 
+    result, its elapsed time in seconds, the peak memory in bytes 
+    allocated while it was running and the time in seconds of a whole 
+    timing loop. The function is called in loops lasting at least 0.2 s
+    each (see `timeit.Timer.autorange`), so fast cases are not dominated
+    by timer noise, and the median time per call out of `repeat` loops 
+    is returned. The peak memory is measured on a separate run, as 
+    tracing allocations slows the function down.
+    """
+    def _run():
+        result = func()
+        if hasattr(result, 'load'):
+            result = result.load()
+        return result
+
+    # The first call also warms up caches (e.g. compiled kernels)
+    result = _run()
+    timer = timeit.Timer(_run)
+    number, _ = timer.autorange()
+    loops = timer.repeat(repeat=repeat, number=number)
+    loop = float(np.median(loops))
+
+    tracemalloc.start()
+    try:
+        _run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, loop / number, peak, loop
+
+
+def benchmark_dtype_memory(ds=None, index=['NDVI', 'NDWI', 'NBR', 'MNDWI'],
+                           dtypes=['float64', 'float32']):
+    """
+    Compares the peak memory, run time and output size of
+    `calculate_indices` for different output data types.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset, optional. Sentinel-2 dataset to compute the
+        indices on. Defaults to `synthetic_s2_dataset()`.
+    index : str or list of str, the indices to compute.
+    dtypes : list of the data types to compare.
+
+    Returns
+    -------
+    results : pandas.DataFrame with one row per data type.
+    """
+    from wdc_bandindices import calculate_indices
+
+    if ds is None:
+        ds = synthetic_s2_dataset()
+    input_size = sum(ds[band].nbytes for band in ds.data_vars)
+
+    results = []
+    for dtype in dtypes:
+        output, elapsed, peak, _ = _measure(
+            lambda: calculate_indices(ds, index=index, platform='SENTINEL_2',
+                                      normalise=True, drop=True, quiet=True,
+                                      dtype=dtype))
+        results.append({'dtype': str(np.dtype(dtype)),
+                        'seconds': elapsed,
+                        'peak_MB': peak / 1e6,
+                        'output_MB': output.nbytes / 1e6,
+                        'input_MB': input_size / 1e6})
+
+    results = pd.DataFrame(results).set_index('dtype')
+    print(results.round(2))
+    return results
+
+
+def benchmark_indices(sizes=[(1, 500, 500), (4, 1000, 1000)],
+                      array_backends=['numpy', 'dask'],
+                      dtypes=['float32', 'float64'],
+                      indices=BENCHMARK_INDICES,
+                      repeat=5,
+                      **kwargs):
+    """
+    Benchmarks `calculate_indices` on synthetic Sentinel-2 datasets and 
+    returns the run time, throughput and peak memory of every index 
+    recipe on its own, and of all of them computed together ('ALL').
+    
+    Parameters
+    ----------
+    sizes : list of (time, height, width) tuples, the sizes of the 
+        synthetic datasets.
+    array_backends : list of 'numpy' (data in memory) and/or 'dask' 
+        (data chunked in 512 x 512 pixel tiles per time step).
+    dtypes : list of output data types.
+    indices : list of the indices to benchmark.
+    repeat : int, number of timing loops (of at least 0.2 s each); the
+        median time per call is reported.
+    **kwargs : other options of `calculate_indices` (e.g. 
+        `backend='numexpr'`).
+    
+    Returns
+    -------
+    results : pandas.DataFrame with one row per size, array backend,
+        dtype and index, and 'seconds', 'pixels_per_s', 'peak_MB' and
+        'loop_seconds' (the time of a whole timing loop) columns.
+    """
+    from wdc_bandindices import calculate_indices
+
+    results = []
+    for size in sizes:
+        for array_backend in array_backends:
+            chunks = None
+            if array_backend == 'dask':
+                chunks = {'time': 1, 'y': 512, 'x': 512}
+            ds = synthetic_s2_dataset(*size, dask_chunks=chunks)
+            pixels = int(np.prod(size))
+
+            for dtype in dtypes:
+                for index in indices + ['ALL']:
+                    index_arg = indices if index == 'ALL' else index
+                    _, elapsed, peak, loop = _measure(
+                        lambda: calculate_indices(ds, index=index_arg,
+                                                  platform='SENTINEL_2',
+                                                  normalise=True, drop=True,
+                                                  quiet=True, dtype=dtype,
+                                                  **kwargs),
+                        repeat=repeat)
+                    results.append({'size': 'x'.join(map(str, size)),
+                                    'array_backend': array_backend,
+                                    'dtype': str(np.dtype(dtype)),
+                                    'index': index,
+                                    'seconds': elapsed,
+                                    'pixels_per_s': pixels / elapsed,
+                                    'peak_MB': peak / 1e6,
+                                    'loop_seconds': loop})
+
+    return pd.DataFrame(results).set_index(
+        ['size', 'array_backend', 'dtype', 'index'])
+
+
+def benchmark_backends(ds=None, index=BENCHMARK_INDICES,
+                       backends=['numpy', 'numexpr'], dtype='float32',
+                       repeat=5):
+    """
+    Compares the run time of `calculate_indices` with each of its index
+    `backend`s, computing all of `index` together, and returns the
+    speed-up of each backend over the first one. Whether 'numexpr' pays
+    off depends on the number of cores it can use (see
+    `numexpr.set_num_threads`), so this should be run on the machine
+    the indices are computed on before choosing a backend.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset, optional. Sentinel-2 dataset to compute the
+        indices on. Defaults to `synthetic_s2_dataset(4)`.
+    index : str or list of str, the indices to compute.
+    backends : list of the backends to compare; the first one is the
+        reference for the speed-up.
+    dtype : str, the output data type. Default is 'float32'.
+    repeat : int, number of timing loops; the median is reported.
+
+    Returns
+    -------
+    results : pandas.DataFrame with one row per backend.
+    """
+    from wdc_bandindices import calculate_indices
+
+    if ds is None:
+        ds = synthetic_s2_dataset(4)
+    pixels = ds[list(ds.data_vars)[0]].size
+
+    results = []
+    for backend in backends:
+        _, elapsed, peak, _ = _measure(
+            lambda: calculate_indices(ds, index=index, platform='SENTINEL_2',
+                                      normalise=True, drop=True, quiet=True,
+                                      dtype=dtype, backend=backend),
+            repeat=repeat)
+        results.append({'backend': backend,
+                        'seconds': elapsed,
+                        'pixels_per_s': pixels / elapsed,
+                        'peak_MB': peak / 1e6})
+
+    results = pd.DataFrame(results).set_index('backend')
+    results['speedup'] = results['seconds'].iloc[0] / results['seconds']
+    print(results.round(3))
+    return results
+
+
+def cloudy_s2_dataset(cloud_cover=0.5, cloud_size=32, seed=0, **kwargs):
+    """
+    Returns `synthetic_s2_dataset(**kwargs)` as float32 surface
+    reflectance, with a fraction `cloud_cover` of its pixels masked to
+    NaN (as after `cleaning_s2`) in square clouds of `cloud_size` pixels.
+    """
+    ds = synthetic_s2_dataset(seed=seed, **kwargs).drop_vars('scl')
+    time_steps, height, width = ds.red.shape
+    rng = np.random.default_rng(seed)
+    cells = rng.random((time_steps, -(-height // cloud_size),
+                        -(-width // cloud_size))) < cloud_cover
+    clouds = cells.repeat(cloud_size, 1).repeat(cloud_size, 2)
+    clouds = xr.DataArray(clouds[:, :height, :width], dims=ds.red.dims)
+    return ds.astype(np.float32).where(~clouds)
+
+
+def benchmark_valid_only(cloud_covers=[0, 0.5, 0.8, 0.95],
+                         index=BENCHMARK_INDICES, repeat=5, **kwargs):
+    """
+    Compares the run time of `calculate_indices` with and without
+    `valid_only=True` on cloudy datasets (see `cloudy_s2_dataset`), and
+    returns the speed-up of `valid_only=True` for each cloud cover.
+
+    Parameters
+    ----------
+    cloud_covers : list of the fractions of cloudy pixels to compare.
+    index : str or list of str, the indices to compute.
+    repeat : int, number of timing loops; the median is reported.
+    **kwargs : options of `synthetic_s2_dataset` (e.g. `time_steps`).
+
+    Returns
+    -------
+    results : pandas.DataFrame with one row per cloud cover.
+    """
+    from wdc_bandindices import calculate_indices
+
+    kwargs.setdefault('time_steps', 4)
+    results = []
+    for cloud_cover in cloud_covers:
+        ds = cloudy_s2_dataset(cloud_cover, **kwargs)
+        row = {'cloud_cover': cloud_cover}
+        for valid_only in [False, True]:
+            _, elapsed, _, _ = _measure(
+                lambda: calculate_indices(ds, index=index,
+                                          platform='SENTINEL_2',
+                                          normalise=True, drop=True,
+                                          quiet=True, valid_only=valid_only),
+                repeat=repeat)
+            row[f'seconds_valid_only_{valid_only}'] = elapsed
+        results.append(row)
+
+    results = pd.DataFrame(results).set_index('cloud_cover')
+    results['speedup'] = (results['seconds_valid_only_False'] /
+                          results['seconds_valid_only_True'])
+    print(results.round(3))
+    return results
+
+
+def check_regression(results, baseline, tolerance=0.25, min_seconds=0.1):
+    """
+    Compares benchmark results against a baseline and raises an 
+    exception listing every case whose throughput dropped, or whose 
+    peak memory grew, by more than `tolerance` (a fraction). The 
+    throughput of cases whose timing loops lasted less than 
+    `min_seconds` is not checked, as it varies more than `tolerance` 
+    between processes. As each loop lasts at least 0.2 s (see 
+    `_measure`), fast cases are checked as well as slow ones.
+    
+    Parameters
+    ----------
+    results : pandas.DataFrame returned by `benchmark_indices`.
+    baseline : pandas.DataFrame returned by `benchmark_indices`, or the
+        filename of a CSV file it was saved to with `to_csv`.
+    tolerance : float, allowed relative change. Default is 0.25, as 
+        timings on a shared machine vary by 10-20% between runs.
+    min_seconds : float, minimum time of a timing loop (in the baseline)
+        for the throughput of a case to be checked. Baselines saved 
+        without a 'loop_seconds' column are checked against the time per
+        call instead. Default is 0.1.
+    """
+    if isinstance(baseline, str):
+        baseline = pd.read_csv(baseline, index_col=[0, 1, 2, 3])
+    results = results.copy()
+    results.index = results.index.map(lambda key: tuple(map(str, key)))
+    baseline = baseline.copy()
+    baseline.index = baseline.index.map(lambda key: tuple(map(str, key)))
+    common = results.index.intersection(baseline.index)
+    loop_column = ('loop_seconds' if 'loop_seconds' in baseline.columns
+                   else 'seconds')
+    timed = baseline.loc[common, loop_column] >= min_seconds
+
+    slower = ((results.loc[common, 'pixels_per_s'] <
+               baseline.loc[common, 'pixels_per_s'] * (1 - tolerance)) &
+              timed)
+    larger = (results.loc[common, 'peak_MB'] >
+              baseline.loc[common, 'peak_MB'] * (1 + tolerance))
+
+    regressions = []
+    for key in common[slower.values]:
+        regressions.append(f"{'/'.join(key)}: throughput "
+                           f"{results.loc[key, 'pixels_per_s']:.3g} pixels/s "
+                           f"(baseline {baseline.loc[key, 'pixels_per_s']:.3g})")
+    for key in common[larger.values]:
+        regressions.append(f"{'/'.join(key)}: peak memory "
+                           f"{results.loc[key, 'peak_MB']:.1f} MB "
+                           f"(baseline {baseline.loc[key, 'peak_MB']:.1f})")
+
+    if regressions:
+        raise Exception(f'{len(regressions)} benchmark regression(s) '
+                        f'beyond {tolerance:.0%}:\n' + '\n'.join(regressions))
+    print(f'No regression beyond {tolerance:.0%} in {len(common)} benchmarks '
+          f'(throughput checked in {int(timed.sum())} timed over loops of at '
+          f'least {min_seconds} s).')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark calculate_indices on synthetic Sentinel-2 data.')
+    parser.add_argument('--baseline', help='CSV file of baseline results to '
+                        'check for regressions against')
+    parser.add_argument('--save', help='CSV file to save the results to')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--min-seconds', type=float, default=0.1,
+                        help='minimum time of a timing loop for the '
+                        'throughput of a case to be checked')
+    parser.add_argument('--quick', action='store_true',
+                        help='only benchmark a small dataset held in memory')
+    args = parser.parse_args()
+
+    options = {}
+    if args.quick:
+        options = {'sizes': [(1, 500, 500)], 'array_backends': ['numpy'],
+                   'repeat': 3}
+    results = benchmark_indices(**options)
+    print(results.round(3).to_string())
+    if args.save:
+        results.to_csv(args.save)
+    if args.baseline:
+        check_regression(results, args.baseline, args.tolerance,
+                         args.min_seconds)
@@ -40,14 +40,105 @@ Last modified: May 2021
 # from sklearn.model_selection import BaseCrossValidator
 
 import warnings
-from rasterstats import zonal_stats
 import numpy as np
 
 
-def collect_training_data(data, shpFile=None, affine=None, method='median'):
+def _polygon_pixels(geometries, affine, shape, all_touched=False):
+    """
+    Rasterises each polygon once, over its own bounding window (as 
+    rasterstats does), and returns the flat indices of the pixels of all
+    the polygons one after the other, and the number of pixels of each
+    polygon. Overlapping polygons keep all their pixels.
+    """
+    from affine import Affine
+    from rasterio.features import geometry_mask
+    
+    height, width = shape
+    index, sizes = [], []
+    for geom in geometries:
+        if geom is None or geom.is_empty:
+            sizes.append(0)
+            continue
+        xmin, ymin, xmax, ymax = geom.bounds
+        cols, rows = zip(*[~affine * corner for corner in 
+                           [(xmin, ymin), (xmin, ymax), (xmax, ymin), (xmax, ymax)]])
+        row0, col0 = max(int(np.floor(min(rows))), 0), max(int(np.floor(min(cols))), 0)
+        row1, col1 = min(int(np.ceil(max(rows))), height), min(int(np.ceil(max(cols))), width)
+        if row1 <= row0 or col1 <= col0:
+            sizes.append(0)
+            continue
+        
+        mask = geometry_mask([geom], out_shape=(row1 - row0, col1 - col0),
+                             transform=affine * Affine.translation(col0, row0),
+                             invert=True, all_touched=all_touched)
+        rows, cols = np.nonzero(mask)
+        index.append((rows + row0) * width + cols + col0)
+        sizes.append(len(rows))
+    
+    index = np.concatenate(index) if index else np.zeros(0, dtype=np.intp)
+    return index, np.asarray(sizes)
+
+
+def _training_stats(stack, geometries, affine, methods):
+    """
+    Returns the statistics `methods` of every array of `stack` (a list
+    of arrays or a (band, y, x) array) for each polygon, as an array of 
+    shape (polygon, band * method).
+    """
+    from wdc_datahandling import _grouped_stats
+    
+    index, sizes = _polygon_pixels(geometries, affine, stack[0].shape)
+    
+    # Values of the training pixels of all the arrays, polygon by 
+    # polygon, as a (band, pixel) stack; the pixels are taken before 
+    # casting so no full-size copy of any array is made
+    values = np.stack([np.asarray(array).ravel().take(index).astype(np.float64)
+                       for array in stack])
+    has_pixels = sizes > 0
+    starts = (np.cumsum(sizes) - sizes)[has_pixels]
+    
+    stats = np.full((len(stack), len(methods), len(sizes)), np.nan)
+    if has_pixels.any():
+        stats[..., has_pixels] = _grouped_stats(values, starts, methods)
+    return stats.transpose(2, 0, 1).reshape(len(sizes), -1)
+
+
+def _training_stats_batch(filename, geometries, affine, methods):
+    """
+    Worker of the parallel mode of `collect_training_data`: computes the
+    statistics of a batch of polygons on the feature stack memory-mapped
+    from `filename`, so the stack is shared through the page cache 
+    instead of being pickled for every batch. Only the pixels of the 
+    batch's polygons are read from the map (see `_training_stats`), so
+    a batch never loads or copies whole bands.
+    """
+    stack = np.load(filename, mmap_mode='r')
+    return _training_stats(stack, geometries, affine, methods)
+
+
+def _spatial_batches(geometries, affine, batch_size, tile_size=512):
+    """
+    Splits polygons into batches of at most `batch_size` polygons that 
+    are spatially compact, by sorting them by the tile (of `tile_size` 
+    pixels) containing their centre. Returns a list of arrays of 
+    polygon positions.
+    """
+    bounds = np.asarray(geometries.bounds)
+    cols, rows = ~affine * ((bounds[:, 0] + bounds[:, 2]) / 2,
+                            (bounds[:, 1] + bounds[:, 3]) / 2)
+    tile_rows = np.nan_to_num(np.asarray(rows) // tile_size)
+    tile_cols = np.nan_to_num(np.asarray(cols) // tile_size)
+    order = np.lexsort((cols, tile_cols, tile_rows))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def collect_training_data(data, shpFile=None, affine=None, method='median',
+                          n_workers=None, batch_size=500, progress_cbk=None):
     """
     Collect values from one or multiple numpy.ndarray(s) for
-    each feature of a shape file and return a median values
+    each feature of a shape file and return a median values.
+    The polygons are read and rasterised once, and the statistics
+    of all the arrays are computed in one vectorised pass.
     Last modified: August 2021
     
     Parameters
@@ -57,7 +148,7 @@ def collect_training_data(data, shpFile=None, affine=None, method='median'):
             Order of dimensions is important as can be affected
             latter on by the flattening (training step).
     shpFile : filename of the shapefile containing the training
-            areas (i.e., polygons). Required.
+            areas (i.e., polygons), or a geopandas.GeoDataFrame. Required.
     affine : affine of the raster (rasterio python library). Required.
             Must have the following format : Affine(a, b, c, d, e, f), with
             a = width of a pixel
@@ -67,20 +158,31 @@ def collect_training_data(data, shpFile=None, affine=None, method='median'):
             e = height of a pixel (typically negative)
             f = y-coordinate of the of the upper-left corner of the upper-left pixel
     method : a string with the statistic method to use when
-            collecting numpy.ndarray's values. By default median value will be
-            returned for each polygon feature.
+            collecting numpy.ndarray's values, or a list of them. By 
+            default median value will be returned for each polygon feature.
+            NaN values are ignored.
+    n_workers : number of processes used to compute the statistics of 
+            batches of polygons in parallel. By default (None or 1) they
+            are computed in the main process.
+    batch_size : number of polygons per batch in parallel mode. The
+            batches group polygons that are close to each other. 
+            Default is 500.
+    progress_cbk : a function called with the number of batches 
+            completed and the total number of batches, in parallel mode.
+            Optional.
         
     Returns
     -------
     training_data : a numpy.ndarray object of dimension ('X','Y')
         where 'X' is the number of samples (i.e., number of
         features in shp) and 'Y' the length of the 'data' list
+        (times the number of methods if a list of methods is given, 
+        with the methods of each array next to each other). Polygons 
+        without any valid pixel get NaN values.
         
     """
     
-    def _extract_val(val):
-        return val[method]
-    
+    methods = [method] if isinstance(method, str) else list(method)
 
     if shpFile is None:
         
@@ -92,7 +194,8 @@ def collect_training_data(data, shpFile=None, affine=None, method='median'):
                          "Please refer to the function documentation \n"
                          "for detailed information.")
 
-    elif method not in ['min', 'max', 'median', 'mean', 'sum', 'std']:
+    elif any(m not in ['min', 'max', 'median', 'mean', 'sum', 'std'] 
+             for m in methods):
         
         raise ValueError(f"'{method}' is not a valid option for "
                             "`method`. Please specify either \n"
@@ -109,12 +212,20 @@ def collect_training_data(data, shpFile=None, affine=None, method='median'):
                             "the function documentation to verify your parameters \n"
                             "meet all the format requirements.")
     
-        training_data = []
+        import geopandas as gpd
         
-        for array in data:
-            zs = zonal_stats(shpFile, array, affine=affine , stats=[method])
-            training_data.append(list(map(_extract_val, zs)))
-        training_data = np.transpose(np.asarray(training_data))
+        if isinstance(shpFile, gpd.GeoDataFrame):
+            polygons = shpFile
+        else:
+            polygons = gpd.read_file(shpFile)
+        
+        if n_workers is None or n_workers <= 1:
+            training_data = _training_stats(data, polygons.geometry, affine, 
+                                            methods)
+        else:
+            training_data = _collect_training_data_parallel(
+                data, polygons.geometry, affine, methods, n_workers,
+                batch_size, progress_cbk)
 
     else:
         
@@ -123,4 +234,371 @@ def collect_training_data(data, shpFile=None, affine=None, method='median'):
                          "the function documentation to verify your parameters \n"
                          "meet all the format requirements.")
 
-    return training_data
\ No newline at end of file
+    return training_data
+
+
+def _collect_training_data_parallel(data, geometries, affine, methods,
+                                    n_workers, batch_size, progress_cbk):
+    """
+    Parallel mode of `collect_training_data`: the arrays are written 
+    once to a memory-mapped (band, y, x) stack in a temporary directory,
+    and spatially compact batches of polygons are processed by a pool 
+    of `n_workers` processes that all map the same file.
+    """
+    import os
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    
+    batches = _spatial_batches(geometries, affine, batch_size)
+    training_data = np.full((len(geometries), len(data) * len(methods)), np.nan)
+    
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'stack.npy')
+        stack = np.lib.format.open_memmap(
+            filename, mode='w+', dtype=np.result_type(*data), 
+            shape=(len(data),) + data[0].shape)
+        for i, array in enumerate(data):
+            stack[i] = array
+        stack.flush()
+        del stack
+        
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(_training_stats_batch, filename,
+                                       geometries.iloc[batch], affine, methods): batch
+                       for batch in batches}
+            for done, future in enumerate(as_completed(futures), start=1):
+                training_data[futures[future]] = future.result()
+                if progress_cbk is not None:
+                    progress_cbk(done, len(batches))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    
+    return training_data
+
+
+def _bottom_k(keys, k):
+    """
+    Returns the positions of the `k` smallest `keys` (all of them if 
+    there are no more than `k`).
+    """
+    if k is None or len(keys) <= k:
+        return np.arange(len(keys))
+    return np.argpartition(keys, k)[:k]
+
+
+def collect_training_pixels(data, shpFile=None, affine=None, class_column='class',
+                            max_per_class=None, drop_nan=True, tile_size=1024,
+                            random_state=0):
+    """
+    Collect the values of each pixel of the training areas of a shape 
+    file, one feature row per pixel, with optional per-class caps. The
+    feature stack is read tile by tile (only the tiles intersecting the
+    polygons), so a memory-mapped stack never needs to fit in memory,
+    and at most `max_per_class` pixels per class are held at any time: 
+    each candidate pixel gets a random key and the pixels with the 
+    smallest keys are kept, which is a stratified random sample without 
+    replacement.
+    
+    Parameters
+    ----------
+    data : a list of one or multiple numpy.ndarray(s) with dimensions 
+            ('y','x'), a numpy.ndarray (e.g. a numpy.memmap) with 
+            dimensions ('band','y','x'), or the filename of such an 
+            array saved with numpy.save (opened memory-mapped). Required.
+    shpFile : filename of the shapefile containing the training
+            areas (i.e., polygons), or a geopandas.GeoDataFrame. Required.
+    affine : affine of the raster (rasterio python library), see 
+            `collect_training_data`. Required.
+    class_column : name of the column of the shape file with the class
+            of each polygon. Default is 'class'.
+    max_per_class : maximum number of pixels sampled per class. By 
+            default all the pixels are returned.
+    drop_nan : if True (default), pixels with a NaN value in any array
+            are left out.
+    tile_size : size of the tiles the stack is read by. Default is 1024.
+    random_state : seed of the random sampling. Default is 0.
+        
+    Returns
+    -------
+    X : a numpy.ndarray of dimension ('X','Y') where 'X' is the number
+        of sampled pixels and 'Y' the number of arrays.
+    y : a numpy.ndarray with the class of each sampled pixel.
+        
+    """
+    import geopandas as gpd
+    from affine import Affine
+    from rasterio.features import rasterize
+    from shapely.geometry import box
+    from wdc_datahandling import tile_windows
+    
+    if shpFile is None:
+        raise ValueError("Filename of a polygon shapefile is required.")
+    if affine is None:
+        raise ValueError("'affine' has to be Affine(a, b, c, d, e, f) format. "
+                         "Please refer to the function documentation \n"
+                         "for detailed information.")
+    
+    if isinstance(data, str):
+        data = np.load(data, mmap_mode='r')
+    if isinstance(shpFile, gpd.GeoDataFrame):
+        polygons = shpFile
+    else:
+        polygons = gpd.read_file(shpFile)
+    if class_column not in polygons.columns:
+        raise ValueError(f"'{class_column}' is not a column of the shape file.")
+    
+    classes, codes = np.unique(polygons[class_column].values, return_inverse=True)
+    codes = codes + 1
+    rng = np.random.default_rng(random_state)
+    dtype = np.result_type(*[array.dtype for array in data], np.float32)
+    height, width = data[0].shape
+    
+    # Pixels kept so far for each class: random keys and feature rows
+    kept_keys = [np.zeros(0) for _ in classes]
+    kept_rows = [np.zeros((0, len(data)), dtype=dtype) for _ in classes]
+    
+    for rows, cols in tile_windows(height, width, tile_size):
+        transform = affine * Affine.translation(cols.start, rows.start)
+        corners = [transform * (0, 0), 
+                   transform * (cols.stop - cols.start, rows.stop - rows.start)]
+        (x0, y0), (x1, y1) = corners
+        candidates = np.sort(polygons.sindex.query(
+            box(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))))
+        if len(candidates) == 0:
+            continue
+        
+        labels = rasterize(zip(polygons.geometry.values[candidates], 
+                               codes[candidates].tolist()),
+                           out_shape=(rows.stop - rows.start, cols.stop - cols.start),
+                           transform=transform, fill=0, dtype='int32')
+        pixel_rows, pixel_cols = np.nonzero(labels)
+        if len(pixel_rows) == 0:
+            continue
+        pixel_codes = labels[pixel_rows, pixel_cols]
+        values = np.stack([np.asarray(array[rows, cols])[pixel_rows, pixel_cols]
+                           for array in data], axis=-1).astype(dtype)
+        if drop_nan:
+            valid = ~np.isnan(values).any(axis=-1)
+            values, pixel_codes = values[valid], pixel_codes[valid]
+        keys = rng.random(len(pixel_codes))
+        
+        for code in np.unique(pixel_codes):
+            in_class = pixel_codes == code
+            merged_keys = np.concatenate([kept_keys[code - 1], keys[in_class]])
+            merged_rows = np.concatenate([kept_rows[code - 1], values[in_class]])
+            keep = _bottom_k(merged_keys, max_per_class)
+            kept_keys[code - 1], kept_rows[code - 1] = merged_keys[keep], merged_rows[keep]
+    
+    X = np.concatenate(kept_rows)
+    y = np.repeat(classes, [len(keys) for keys in kept_keys])
+    return X, y
+
+
+def _predict_block(block, model, proba):
+    """
+    Predicts the class (and with `proba=True` the class probabilities)
+    of each pixel of a block of shape (y, x, band), skipping pixels with
+    NaN features. Returns a float32 array of shape (y, x, output) with 
+    NaN for skipped pixels; non-numeric classes are returned as their 
+    position in `model.classes_`.
+    """
+    pixels = block.reshape(-1, block.shape[-1])
+    valid = ~np.isnan(pixels).any(axis=1)
+    n_outputs = 1 + (len(model.classes_) if proba else 0)
+    out = np.full((len(pixels), n_outputs), np.nan, dtype=np.float32)
+    
+    if valid.any():
+        features = pixels[valid]
+        if hasattr(model, 'cluster_centers_'):
+            # k-means only predicts features of the type it was fitted on
+            features = features.astype(model.cluster_centers_.dtype, copy=False)
+        prediction = model.predict(features)
+        if prediction.dtype.kind not in 'biuf':
+            prediction = np.searchsorted(model.classes_, prediction)
+        out[valid, 0] = prediction
+        if proba:
+            out[valid, 1:] = model.predict_proba(features)
+    return out.reshape(block.shape[:-1] + (n_outputs,))
+
+
+def predict_xr(model, input_xr, proba=False, tile_size=1024, n_workers=None,
+               filename=None):
+    """
+    Predict the class of each pixel of a feature dataset with a fitted 
+    scikit-learn model, chunk by chunk and in parallel, with bounded 
+    memory. Each chunk is flattened to a (pixel, feature) table and only
+    its pixels without NaN features (e.g. masked or out of the area) are
+    predicted.
+    
+    Parameters
+    ----------
+    model : a fitted scikit-learn estimator, classifier or clusterer 
+            (with `predict_proba` if `proba` is True).
+    input_xr : xarray.Dataset with one ('y','x') variable per feature, 
+            in the order of the features the model was trained on. It 
+            can be backed by numpy or dask arrays.
+    proba : if True, the class probabilities are returned too. Default 
+            is False.
+    tile_size : size of the chunks of a dataset held in memory. Dask 
+            backed datasets keep their spatial chunks. Default is 1024.
+    n_workers : number of threads predicting chunks in parallel. By 
+            default, all the cores are used.
+    filename : optional. If given, the predictions (and probabilities)
+            are written chunk by chunk to this compressed GeoTIFF file 
+            with `export_to_GeoTiff` instead of being computed in memory,
+            with the predictions as first band and the probabilities of
+            each class as next bands.
+        
+    Returns
+    -------
+    output_xr : xarray.Dataset with a 'Predictions' variable (float32, 
+            NaN where not predicted; non-numeric classes are given as 
+            their position in the 'classes' attribute), and with 
+            `proba=True` a 'Probabilities' variable along a 'class' 
+            dimension. It is computed, unless a `filename` is given, in
+            which case it is returned lazily.
+        
+    """
+    import dask
+    import xarray as xr
+    from wdc_datahandling import spatial_dims, export_to_GeoTiff
+    
+    ydim, xdim = spatial_dims(input_xr)
+    if not input_xr.chunks:
+        input_xr = input_xr.chunk({ydim: tile_size, xdim: tile_size})
+    features = input_xr.to_array('band').transpose(ydim, xdim, 'band'
+                                                   ).chunk({'band': -1})
+    n_outputs = 1 + (len(model.classes_) if proba else 0)
+    
+    outputs = xr.apply_ufunc(_predict_block, features,
+                             input_core_dims=[['band']],
+                             output_core_dims=[['output']],
+                             kwargs={'model': model, 'proba': proba},
+                             dask='parallelized',
+                             output_dtypes=[np.float32],
+                             dask_gufunc_kwargs={'output_sizes': {'output': n_outputs}})
+    
+    output_xr = xr.Dataset({'Predictions': outputs.isel(output=0, drop=True)},
+                           attrs=input_xr.attrs)
+    if (hasattr(model, 'classes_') and 
+            np.asarray(model.classes_).dtype.kind not in 'biuf'):
+        output_xr['Predictions'].attrs['classes'] = list(map(str, model.classes_))
+    if proba:
+        output_xr['Probabilities'] = (outputs.isel(output=slice(1, None))
+                                      .rename(output='class')
+                                      .assign_coords({'class': model.classes_})
+                                      .transpose('class', ydim, xdim))
+    
+    with dask.config.set(scheduler='threads', num_workers=n_workers):
+        if filename is not None:
+            # One band per output, as rasters cannot mix 2D and 3D variables
+            bands = [output_xr.Predictions.expand_dims(band=['Predictions'])]
+            if proba:
+                bands.append(output_xr.Probabilities.rename({'class': 'band'})
+                             .assign_coords(band=[f'Probability_{c}' for c in model.classes_]))
+            stack = xr.concat(bands, dim='band')
+            stack.attrs['long_name'] = tuple(map(str, stack.band.values))
+            export_to_GeoTiff(stack, filename=filename, compress='DEFLATE')
+        else:
+            output_xr = output_xr.compute()
+    return output_xr
+
+
+def sample_valid_pixels(input_xr, n_samples=100000, tile_size=1024, 
+                        random_state=0):
+    """
+    Randomly sample pixels without NaN features from a feature dataset,
+    reading it tile by tile so that it never needs to fit in memory: 
+    each valid pixel gets a random key and the `n_samples` pixels with 
+    the smallest keys are kept.
+    
+    Parameters
+    ----------
+    input_xr : xarray.Dataset with one ('y','x') variable per feature.
+    n_samples : number of pixels to sample. Default is 100000.
+    tile_size : size of the tiles the dataset is read by. Default is 1024.
+    random_state : seed of the random sampling. Default is 0.
+        
+    Returns
+    -------
+    samples : a numpy.ndarray of dimension ('X','Y') where 'X' is the 
+        number of sampled pixels and 'Y' the number of features, with 
+        the data type of the features (at least float32).
+        
+    """
+    from wdc_datahandling import spatial_dims, tile_windows
+    
+    ydim, xdim = spatial_dims(input_xr)
+    rng = np.random.default_rng(random_state)
+    dtype = np.result_type(*[input_xr[var].dtype for var in input_xr.data_vars],
+                           np.float32)
+    kept_keys = np.zeros(0)
+    samples = np.zeros((0, len(input_xr.data_vars)), dtype=dtype)
+    
+    for rows, cols in tile_windows(len(input_xr[ydim]), len(input_xr[xdim]), tile_size):
+        tile = input_xr.isel({ydim: rows, xdim: cols})
+        pixels = np.stack([np.asarray(tile[var].transpose(ydim, xdim)).ravel()
+                           for var in input_xr.data_vars], axis=-1).astype(dtype)
+        pixels = pixels[~np.isnan(pixels).any(axis=1)]
+        keys = np.concatenate([kept_keys, rng.random(len(pixels))])
+        pixels = np.concatenate([samples, pixels])
+        keep = _bottom_k(keys, n_samples)
+        kept_keys, samples = keys[keep], pixels[keep]
+    
+    return samples
+
+
+def unsupervised_classification(input_xr, n_clusters=8, n_samples=100000,
+                                batch_size=4096, tile_size=1024, n_workers=None,
+                                filename=None, random_state=0):
+    """
+    Unsupervised classification of a feature dataset: a mini-batch 
+    k-means clusterer is fitted on a random sample of valid pixels 
+    (see `sample_valid_pixels`), then the cluster of every pixel is 
+    predicted tile by tile in parallel with `predict_xr`, so large
+    multi-temporal stacks are never loaded at once.
+    
+    Parameters
+    ----------
+    input_xr : xarray.Dataset with one ('y','x') variable per feature 
+            (e.g. one per band and date). It can be backed by numpy or 
+            dask arrays.
+    n_clusters : number of clusters. Default is 8.
+    n_samples : number of pixels sampled to fit the clusterer. Default
+            is 100000.
+    batch_size : size of the mini-batches of the clusterer. Default is 
+            4096.
+    tile_size : size of the tiles the dataset is read and predicted by.
+            Default is 1024.
+    n_workers : number of threads predicting tiles in parallel. By 
+            default, all the cores are used.
+    filename : optional. If given, the clusters are written to this 
+            GeoTIFF file instead of being computed in memory, see 
+            `predict_xr`.
+    random_state : seed of the sampling and of the clusterer. Default 
+            is 0.
+        
+    Returns
+    -------
+    output_xr : xarray.Dataset with the cluster of each pixel in a 
+            'Predictions' variable (NaN for pixels with NaN features).
+    model : the fitted sklearn.cluster.MiniBatchKMeans clusterer.
+        
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    
+    samples = sample_valid_pixels(input_xr, n_samples=n_samples,
+                                  tile_size=tile_size, random_state=random_state)
+    if len(samples) < n_clusters:
+        raise ValueError(f"Only {len(samples)} valid pixels were found; at "
+                         f"least n_clusters={n_clusters} are required.")
+    
+    model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+                            random_state=random_state, n_init=3)
+    model.fit(samples)
+    
+    output_xr = predict_xr(model, input_xr, tile_size=tile_size,
+                           n_workers=n_workers, filename=filename)
+    return output_xr, model
@@ -11,85 +11,444 @@ Contact: If you need assistance, please contact Richard Lucas or
 Carole Planque from Aberystwyth University.
 '''
 
+import functools
+import numpy as np
 
-def export_to_GeoTiff(xarray, bandname=None, filename=None):
+
+def spatial_dims(ds):
+    """
+    Takes an xarray object and returns the names of its (y, x) spatial 
+    dimensions, i.e. ('latitude', 'longitude') or ('y', 'x').
+    """
+    if ('latitude' in ds.dims) and ('longitude' in ds.dims):
+        return 'latitude', 'longitude'
+    elif ('y' in ds.dims) and ('x' in ds.dims):
+        return 'y', 'x'
+    else:
+        raise Exception(
+                f'Dimensions not recognised; please provide a xarray.Dataset '
+                'with longitude/latitude or x/y dimensions.')
+
+
+def tile_windows(height, width, tile_size=1024):
+    """
+    Splits a raster of shape (height, width) into square tiles and returns
+    the (y slice, x slice) of each tile, row by row. Tiles on the bottom 
+    and right edges may be smaller than `tile_size`.
+    
+    Parameters
+    ----------
+    height, width : int, size of the raster in pixels.
+    tile_size : int, size of the tiles in pixels. Default is 1024.
+    """
+    return [(slice(y, min(y + tile_size, height)),
+             slice(x, min(x + tile_size, width)))
+            for y in range(0, height, tile_size)
+            for x in range(0, width, tile_size)]
+
+
+def export_to_GeoTiff(xarray, bandname=None, filename=None, cog=False,
+                      compress=None, predictor=None, blocksize=512,
+                      overviews=None, num_threads='ALL_CPUS'):
+    """
+    Exports an xarray.DataArray or xarray.Dataset to a GeoTIFF file.
+    
+    By default the file is written as before (untiled, uncompressed). 
+    With `cog=True` or a `compress` method, the file is written with
+    internal tiles, compressed using `num_threads` threads, window by 
+    window (or dask chunk by dask chunk), so large arrays are streamed 
+    to disk with bounded memory. With `cog=True` it is then turned into
+    a Cloud Optimised GeoTIFF with overviews, which opens quickly in 
+    QGIS.
+    
+    Parameters
+    ----------
+    xarray : xarray.DataArray or xarray.Dataset
+    bandname : str, optional. Name of the band if `xarray` is a 
+        DataArray.
+    filename : str, name of the output file.
+    cog : bool, optional. If True, writes a Cloud Optimised GeoTIFF. 
+        Default is False.
+    compress : str, optional. Compression method, e.g. 'DEFLATE', 'ZSTD'
+        or 'LZW'. Default is None, or 'DEFLATE' if `cog` is True.
+    predictor : int, optional. Predictor used with the compression:
+        1 (none), 2 (horizontal differencing, for integers) or 3 
+        (floating point). Default is 2 or 3 depending on the data type.
+    blocksize : int, optional. Size of the internal tiles. Default is 512.
+    overviews : list of int, optional. Overview decimation factors, 
+        e.g. [2, 4, 8, 16]. Default is none, or automatic if `cog` is 
+        True.
+    num_threads : int or 'ALL_CPUS', threads used to compress the data.
+        Default is 'ALL_CPUS'.
+    """
+    import os
+    import shutil
+    import tempfile
+    import threading
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+    
     if filename is None:
         raise Exception(f'Filename is missing! You must specify a filename to export your xarray.')
     if bandname is not None:
         xarray = xarray.to_dataset(name=bandname)
+    
+    if not cog and compress is None and overviews is None:
         xarray.rio.to_raster(filename)
-    else:
-        xarray.rio.to_raster(filename)
+        print("Array exported to "+filename) 
+        return
+    
+    if compress is None:
+        compress = 'DEFLATE' if cog else 'NONE'
+    if predictor is None:
+        dtypes = ([xarray.dtype] if not hasattr(xarray, 'data_vars') 
+                  else [xarray[var].dtype for var in xarray.data_vars])
+        predictor = 3 if any(np.dtype(dtype).kind == 'f' for dtype in dtypes) else 2
+    if compress.upper() == 'NONE':
+        predictor = 1
+    options = dict(tiled=True, blockxsize=blocksize, blockysize=blocksize,
+                   compress=compress, predictor=predictor, 
+                   num_threads=num_threads, bigtiff='IF_SAFER')
+    
+    # Dask arrays are written chunk by chunk, in-memory arrays window by
+    # window, to a tiled GeoTIFF; a COG is then copied from it (the 
+    # intermediate file is left uncompressed) as the COG driver can only
+    # create whole files
+    tiled_filename = filename
+    if cog:
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(filename)))
+        tiled_filename = os.path.join(tmpdir, 'tiled.tif')
+        options.update(compress='NONE', predictor=1)
+    try:
+        if xarray.chunks:
+            xarray.rio.to_raster(tiled_filename, lock=threading.Lock(), **options)
+        else:
+            xarray.rio.to_raster(tiled_filename, windowed=True, **options)
+        
+        if overviews is not None:
+            with rasterio.Env(GDAL_NUM_THREADS=num_threads):
+                with rasterio.open(tiled_filename, 'r+') as dst:
+                    dst.build_overviews(overviews, Resampling.average)
+                    dst.update_tags(ns='rio_overview', resampling='average')
+        if cog:
+            rasterio.shutil.copy(tiled_filename, filename, driver='COG',
+                                 blocksize=blocksize, compress=compress,
+                                 predictor={1: 'NO', 2: 'STANDARD', 
+                                            3: 'FLOATING_POINT'}[predictor],
+                                 num_threads=num_threads,
+                                 overviews='AUTO' if overviews is None else 'FORCE_USE_EXISTING',
+                                 overview_resampling='AVERAGE',
+                                 bigtiff='IF_SAFER')
+    finally:
+        if cog:
+            shutil.rmtree(tmpdir, ignore_errors=True)
     print("Array exported to "+filename) 
     
 
-def cleaning_s2(ds):
+def export_to_cube(ds, filename, append=False, chunks=None, complevel=4):
+    """
+    Exports an xarray.Dataset time series to a chunked and compressed
+    Zarr store (filename ending in '.zarr') or NetCDF4 file (any other
+    filename). With `append=True`, the dates of `ds` that are not in the
+    existing store yet are appended along time, without rewriting it, 
+    e.g. after each new Sentinel-1 acquisition. Use `open_cube` to read
+    it back lazily.
+    
+    Parameters
+    ----------
+    ds : xarray.Dataset with time and y/x (or latitude/longitude) 
+        dimensions.
+    filename : str, name of the output store.
+    append : bool, optional. If True and the store exists, appends the 
+        new dates to it. Default is False (the store is overwritten).
+    chunks : dict, optional. Chunk sizes of the store. Default is 1 date
+        by 512 x 512 pixels.
+    complevel : int, optional. Compression level of NetCDF4 files (Zarr
+        stores use the default Zarr compressor). Default is 4.
+    """
+    import os
+    import xarray as xr
+    
+    ydim, xdim = spatial_dims(ds)
+    if chunks is None:
+        chunks = {'time': 1, ydim: 512, xdim: 512}
+    chunks = {dim: min(size, ds.sizes[dim]) for dim, size in chunks.items() 
+              if dim in ds.dims}
+    is_zarr = filename.rstrip('/').endswith('.zarr')
+    
+    if append and os.path.exists(filename):
+        with (xr.open_zarr(filename) if is_zarr else xr.open_dataset(filename)) as existing:
+            stored_times = existing.time.values
+        ds = ds.sel(time=~np.isin(ds.time.values, stored_times))
+        if len(ds.time) == 0:
+            print(f'No new date to append to {filename}.')
+            return
+        if ds.time.values.min() <= stored_times.max():
+            raise Exception(f'New dates must be later than the last date '
+                            f'of {filename} ({stored_times.max()}).')
+        
+        if is_zarr:
+            ds.chunk(chunks).drop_vars([name for name in ds.variables 
+                                        if 'time' not in ds[name].dims],
+                                       errors='ignore'
+                                       ).to_zarr(filename, append_dim='time')
+        else:
+            _append_netcdf(ds, filename)
+        print(f'{len(ds.time)} date(s) appended to {filename}.')
+        return
+    
+    # Fixed time encoding, so dates appended later (e.g. at another time
+    # of day) are stored exactly, whatever the dates of the first export
+    time_encoding = {'units': 'seconds since 1970-01-01', 
+                     'calendar': 'standard', 'dtype': 'float64'}
+    if is_zarr:
+        ds.chunk(chunks).to_zarr(filename, mode='w', 
+                                 encoding={'time': time_encoding})
+    else:
+        # Keep the grid mapping set by rioxarray, so the CRS is read back
+        encoding = {var: {'zlib': True, 'complevel': complevel,
+                          'chunksizes': tuple(chunks.get(dim, ds.sizes[dim]) 
+                                              for dim in ds[var].dims),
+                          **{key: value for key, value in ds[var].encoding.items()
+                             if key == 'grid_mapping'}}
+                    for var in ds.data_vars}
+        encoding['time'] = time_encoding
+        ds.to_netcdf(filename, mode='w', engine='netcdf4', 
+                     unlimited_dims=['time'], encoding=encoding)
+    print("Dataset exported to "+filename)
+
+
+def _append_netcdf(ds, filename):
+    """
+    Appends the dates of `ds` to a NetCDF4 file written by 
+    `export_to_cube`, along its unlimited time dimension, with every 
+    variable and coordinate along time.
+    """
+    import netCDF4
+    import pandas as pd
+    names = [name for name in ds.variables 
+             if name != 'time' and 'time' in ds[name].dims]
+    with netCDF4.Dataset(filename, 'a') as nc:
+        missing = [name for name in names if name not in nc.variables]
+        if missing:
+            raise Exception(f'{missing} are not in {filename}; the dataset '
+                            f'must have the same variables as the file.')
+        start = len(nc.dimensions['time'])
+        end = start + len(ds.time)
+        nc['time'][start:end] = netCDF4.date2num(
+            pd.DatetimeIndex(ds.time.values).to_pydatetime(),
+            nc['time'].units, getattr(nc['time'], 'calendar', 'standard'))
+        for name in names:
+            dims = nc[name].dimensions
+            nc[name][start:end] = ds[name].transpose(*dims).values
+
+
+def open_cube(filename, time=None, y=None, x=None, chunks={}):
+    """
+    Lazily opens a Zarr store or NetCDF file written by `export_to_cube`,
+    optionally selecting a spatial and temporal subset, so that only the
+    chunks of the subset are read when the data is used.
+    
+    Parameters
+    ----------
+    filename : str, name of the store.
+    time : tuple of two dates, optional, e.g. ('2022-01-01', '2022-06-30').
+    y, x : tuples of two coordinates, optional. Extent of the subset 
+        (in any order), along y/x or latitude/longitude.
+    chunks : dict, optional. Dask chunks; default uses the store chunks.
+    
+    Returns
+    -------
+    ds : xarray.Dataset backed by dask arrays.
+    """
+    import xarray as xr
+    if filename.rstrip('/').endswith('.zarr'):
+        ds = xr.open_zarr(filename, chunks=chunks, decode_coords='all')
+    else:
+        ds = xr.open_dataset(filename, chunks=chunks, decode_coords='all')
+    
+    ydim, xdim = spatial_dims(ds)
+    selection = {}
+    if time is not None:
+        selection['time'] = slice(*time)
+    for dim, extent in [(ydim, y), (xdim, x)]:
+        if extent is not None:
+            descending = ds[dim][0] > ds[dim][-1]
+            selection[dim] = slice(*sorted(extent, reverse=bool(descending)))
+    return ds.sel(selection)
+
+
+# Sentinel-2 scene classification (SCL) classes kept as valid observations
+# by `cleaning_s2` (4: vegetation, 5: not vegetated, 6: water,
+# 7: unclassified, 11: snow), as a lookup table indexed by SCL value
+_S2_VALID_SCL = np.zeros(256, dtype=bool)
+_S2_VALID_SCL[[4, 5, 6, 7, 11]] = True
+
+
+def _valid_scl(scl):
+    """
+    Returns a boolean array, True where the Sentinel-2 scene 
+    classification `scl` is one of the valid classes of `cleaning_s2`.
+    """
+    if scl.dtype.kind in 'ui':
+        return _S2_VALID_SCL.take(scl, mode='clip')
+    return np.isin(scl, np.flatnonzero(_S2_VALID_SCL))
+
+
+def _clean_s2_block(band, scl, offset, dtype=None):
+    """
+    Masks, offsets and scales one Sentinel-2 band (see `cleaning_s2`) in
+    a single pass, returning floating point reflectance with NaN where 
+    the pixel is not valid, or with `dtype='uint16'` the offset digital
+    numbers with 0 where the pixel is not valid.
+    """
+    invalid = ~_valid_scl(scl)
+    invalid |= band == 0
+    
+    if dtype is not None and np.dtype(dtype) == np.uint16:
+        corrected = np.add(band, offset, dtype=np.int32)
+        invalid |= corrected == 0
+        # Reflectance at or below zero after the offset cannot be stored 
+        # as uint16, so is clipped to the smallest valid value
+        np.clip(corrected, 1, np.iinfo(np.uint16).max, out=corrected)
+        corrected[invalid] = 0
+        return corrected.astype(np.uint16)
+    
+    # Promote integers to floating point the same way xarray does when
+    # masking with `where`, unless a dtype is requested
+    if dtype is None:
+        dtype = np.result_type(band, np.float32)
+    scaled = np.add(band, offset, dtype=dtype)
+    scaled /= 1000
+    # Set nodata values of 0 to NaN
+    invalid |= scaled == 0
+    scaled[invalid] = np.nan
+    return scaled
+
+
+def cleaning_s2(ds, dtype=None, dask_chunks=None):
     """
     Takes Sentinel-2 dataset and returns a clean dataset (i.e., cloud masked and normalized reflectance).  
     
+    If `ds` is lazily loaded with dask (e.g. with `dask_chunks` in 
+    `dc.load`), or `dask_chunks` is provided, the cleaning stays lazy and
+    is only computed chunk by chunk when the result is used.
+    
     Parameters
     ----------
     ds : xarray.Dataset with scl (i.e., cloud mask) variable.
+    dtype : data type of the output, optional. By default, reflectance is
+        returned as floating point (float32 for uint16 bands) with NaN for
+        masked pixels. 'float32' or 'float64' force that data type. 
+        'uint16' returns a compact output, 4 times smaller than float64: 
+        the reflectance multiplied by 1000 (i.e. the digital numbers with 
+        the offset applied), with 0 for masked pixels (recorded in the 
+        'nodata' attribute of each variable) and values at or below zero 
+        after the offset clipped to 1. Each variable is marked with an
+        'encoded_by' attribute set to 'cleaning_s2', from which
+        `calculate_indices` (and `linear_band_transform`) recognise it:
+        they decode it with its 'scale_factor' and 'nodata' attributes 
+        and return the same indices as from the floating point output 
+        (except for the clipped values), with the same `normalise` 
+        option. Elsewhere, decode it with 
+        `ds.where(ds != 0) * 0.001` (the 'nodata' and 'scale_factor' 
+        attributes).
+    dask_chunks : dict, optional. Chunks used to split `ds` with dask 
+        first, e.g. {'time': 1, 'x': 1024, 'y': 1024}.
     """    
+    import xarray as xr
+    
     print("Cleaning Sentinel-2 images...")
-    ds_clean = ds.where((ds.scl == 4) | (ds.scl == 5) | 
-                        (ds.scl == 6) | (ds.scl == 7) | 
-                        (ds.scl == 11))
-    ds_clean = ds_clean.where(ds_clean != 0)
-    ds_clean = ds_clean.drop('scl')
+    if dask_chunks is not None:
+        ds = ds.chunk(dask_chunks)
     
     # Add negative BOA offset for Sentinel-2 L2A images produced from the 04.00 baseline (i.e., since 25 January 2022)
     # L2A_BOAi = (L2A_DNi + BOA_ADD_OFFSETi) / QUANTIFICATION_VALUEi
-    
     print("(Applying new Copernicus offset after 24 Jan 2022.)")
-    ds_clean_withOFFSET = ds_clean.where(ds_clean.time.dt.year > 2022) - 1000
+    offset = xr.where(ds.time >= np.datetime64('2022-01-25'), -1000, 0)
     
-    ds_clean_withOFFSET_2022 = ds_clean.where((ds_clean.time.dt.month > 1) & (
-                                               ds_clean.time.dt.year == 2022)) - 1000
+    def _clean_band(band):
+        if dtype is None:
+            output_dtype = np.result_type(band, np.float32)
+        else:
+            output_dtype = np.dtype(dtype)
+        return xr.apply_ufunc(_clean_s2_block, band, ds.scl, offset,
+                              kwargs={'dtype': dtype},
+                              dask='parallelized',
+                              output_dtypes=[output_dtype])
     
-    ds_clean_withOFFSET_Jan2022 = ds_clean.where((ds_clean.time.dt.day >= 25) & (
-                                                  ds_clean.time.dt.month == 1) & (
-                                                  ds_clean.time.dt.year == 2022)) - 1000
+    # Mask each band with the valid SCL classes, apply the offset of each
+    # date and scale it in a single pass
+    ds_clean_scaled = ds.drop_vars('scl').map(_clean_band)
     
-    ds_clean_withoutOFFSET_Jan2022 = ds_clean.where((ds_clean.time.dt.day < 25) & (
-                                                     ds_clean.time.dt.month == 1) & (
-                                                     ds_clean.time.dt.year == 2022))
-    
-    ds_clean_withoutOFFSET = ds_clean.where(ds_clean.time.dt.year < 2022)
-    
-    ds_clean_addedOFFSET = ds_clean_withoutOFFSET.fillna(0) + ds_clean_withoutOFFSET_Jan2022.fillna(0
-                         ) + ds_clean_withOFFSET_Jan2022.fillna(0) + ds_clean_withOFFSET_2022.fillna(0
-                         ) + ds_clean_withOFFSET.fillna(0)
-    
-    ds_clean_scaled = ds_clean_addedOFFSET/1000
-    # Set nodata values of 0 to NaN
-    ds_clean_scaled = ds_clean_scaled.where(ds_clean_scaled != 0)
+    if dtype is not None and np.dtype(dtype) == np.uint16:
+        for band in ds_clean_scaled.data_vars:
+            ds_clean_scaled[band].attrs.update({'nodata': 0, 
+                                                'scale_factor': 0.001,
+                                                'encoded_by': 'cleaning_s2'})
     
     return ds_clean_scaled
 
-def cloud_coverage(ds):
+def _count_invalid(values, inside=None):
     """
-    Takes EO dataset and returns the non-valid coverage (%).  
+    Counts, over the last two (spatial) axes, the pixels of `values` that
+    are not valid (NaN or 0) and inside the boolean mask `inside`.
+    """
+    invalid = values == 0
+    if values.dtype.kind == 'f':
+        invalid = invalid | np.isnan(values)
+    if inside is not None:
+        invalid = invalid & inside
+    return np.count_nonzero(invalid, axis=(-2, -1))
+
+
+def cloud_coverage(ds, geopolygon=None):
+    """
+    Takes EO dataset and returns the non-valid coverage (%), i.e. the
+    percentage of pixels of its first variable that are NaN or 0, 
+    optionally counting the pixels inside a polygon only.
     
     Parameters
     ----------
     ds : xarray.Dataset
+    geopolygon : datacube Geometry, optional. Area the coverage is 
+        computed in (e.g. from `geom_fromdrawn`). Default is the whole 
+        extent of the dataset.
+        
+    Returns
+    -------
+    cloud_percentage : pandas.Series of the coverage (%), indexed by time,
+        or a float for a dataset without a time dimension (e.g. a single
+        date selected with `ds.isel(time=0)`).
     """
-    Clouds = ds[list(ds.keys())[0]].fillna(1).where(
-        (9999 - ds[list(ds.keys())[0]].fillna(0))==9999)
+    import xarray as xr
+    ydim, xdim = spatial_dims(ds)
+    var = ds[list(ds.keys())[0]]
     
-    if (('longitude' in ds.dims) & ('latitude' in ds.dims)):
-        area_total_size = len(ds.longitude)*len(ds.latitude)
-        cloud_percentage = Clouds.count(['latitude','longitude'])/area_total_size *100
-        
-    elif (('x' in ds.dims) & ('y' in ds.dims)):
-        area_total_size = len(ds.x)*len(ds.y)
-        cloud_percentage = Clouds.count(['y','x'])/area_total_size *100
+    if geopolygon is not None:
+        # Only the polygon's bounding window can hold pixels inside it
+        inside, window = _geopolygon_mask(ds, geopolygon, window=True)
+        var = var.isel(window)
+        area_total_size = int(inside.sum())
+        if area_total_size == 0:
+            raise Exception('The geopolygon does not cover any pixel of the '
+                            'dataset.')
+        args, core_dims = [var, inside], [[ydim, xdim], [ydim, xdim]]
     else:
-        raise Exception(
-                f'Dimensions not recognised; please provide a xarray.Dataset '
-                'with longitude/latitude or x/y dimensions.')
+        area_total_size = len(ds[xdim])*len(ds[ydim])
+        args, core_dims = [var], [[ydim, xdim]]
     
+    # One count per timestep straight from the validity test, computed 
+    # once so that using the result does not trigger the computation again
+    n_invalid = xr.apply_ufunc(_count_invalid, *args, 
+                               input_core_dims=core_dims,
+                               dask='allowed').compute()
+    cloud_percentage = n_invalid/area_total_size *100
+    if cloud_percentage.ndim == 0:
+        return float(cloud_percentage)
+    cloud_percentage = cloud_percentage.to_series()
+    cloud_percentage.name = 'cloud_coverage'
     return cloud_percentage
 
 
@@ -102,6 +461,44 @@ def geom_fromextent(site):
     return geom_extent
 
 
+# Shapefiles reprojected to EPSG:4326 by `geom_fromdrawn`, with their 
+# spatial index, as (original, reprojected) pairs keyed by the id, CRS,
+# length and bounds of the original, so in-place changes are picked up
+_SHAPEFILE_CACHE = {}
+_SHAPEFILE_CACHE_SIZE = 4
+
+
+def _geometries_4326(shapefile):
+    """
+    Returns the geometries of `shapefile` reprojected to EPSG:4326 (a 
+    GeoSeries with its spatial index built), from a cache holding the 
+    few last shapefiles used so that large layers are reprojected, and 
+    indexed, once only. The cache is keyed on the CRS and a hash of the
+    geometries themselves, so a shapefile edited in place is reprojected
+    again.
+    """
+    import hashlib
+    geometries = shapefile.geometry
+    digest = hashlib.sha1(geometries.isna().values.tobytes())
+    for wkb in geometries.to_wkb():
+        if wkb is not None:
+            digest.update(wkb)
+    key = (digest.hexdigest(), str(shapefile.crs))
+    cached = _SHAPEFILE_CACHE.get(key)
+    if cached is not None:
+        return cached
+    
+    if shapefile.crs is not None and shapefile.crs.to_epsg() == 4326:
+        reprojected = geometries.copy()
+    else:
+        reprojected = geometries.to_crs(epsg=4326)
+    reprojected.sindex
+    if len(_SHAPEFILE_CACHE) >= _SHAPEFILE_CACHE_SIZE:
+        del _SHAPEFILE_CACHE[next(iter(_SHAPEFILE_CACHE))]
+    _SHAPEFILE_CACHE[key] = reprojected
+    return reprojected
+
+
 def geom_fromdrawn(option='Extent', shapefile=None):
     import display_tools
     from datacube.utils.geometry import Geometry, CRS
@@ -113,8 +510,6 @@ def geom_fromdrawn(option='Extent', shapefile=None):
         raise Exception(
                 f'NO GEOMETRY RETURNED; Please draw a polygon first and then re-run this cell.')
     
-    if (shapefile is not None):
-        shapefile = shapefile.to_crs(epsg=4326)
     if option == 'Extent':
         geom_extent = Geometry(geom=geojson, crs=CRS("epsg:4326"))
         id_shapefile = None
@@ -123,40 +518,489 @@ def geom_fromdrawn(option='Extent', shapefile=None):
             raise Exception(
                 f'"Selection" option was provided; please provide a GeoDataFrame '
                 'to select data from')
+        geometries = _geometries_4326(shapefile)
         geom = Polygon([tuple(l) for l in geojson['coordinates'][0]])
-        selected_field = shapefile.loc[shapefile.index == shapefile.contains(geom)[
-                                         shapefile.contains(geom)].index[0]]
-        geom_extent = Geometry(geom= selected_field.geometry[selected_field.index[0]], crs=CRS("epsg:4326"))
-        id_shapefile = selected_field.id.values
+        # Bounding box query of the spatial index, then exact test on the
+        # candidates; the first field containing the drawn polygon is kept,
+        # its attributes read from `shapefile` itself by position
+        containing = geometries.sindex.query(geom, predicate='within')
+        if len(containing) == 0:
+            raise Exception(
+                f'NO FIELD SELECTED; Please draw a polygon inside one of the fields.')
+        position = containing.min()
+        geom_extent = Geometry(geom= geometries.iloc[position], crs=CRS("epsg:4326"))
+        id_shapefile = shapefile.iloc[[position]].id.values
     
     return geom_extent, id_shapefile
 
 
 
-def geopolygon_masking(ds, geopolygon):
-    from shapely.geometry import shape
+@functools.lru_cache(maxsize=16)
+def _rasterise_geometry(wkt, geom_crs, out_crs, out_shape, transform):
+    """
+    Rasterises a polygon given as WKT text on a grid of `out_shape` 
+    pixels and returns a read-only boolean array covering only the 
+    polygon's bounding window, True inside the polygon, and the (row, 
+    column) slices of that window in the grid. Only the pixels around 
+    the polygon are rasterised, and results are cached by the geometry 
+    and grid, so masking the same field against several products of one
+    session rasterises it once per grid without keeping full-grid masks
+    in memory.
+    """
+    import shapely.wkt
     import geopandas as gpd
-    import rasterio
+    import rasterio.features
+    import rasterio.windows
+    from affine import Affine
+    gpd_feature = gpd.GeoSeries([shapely.wkt.loads(wkt)]).set_crs(geom_crs).to_crs(out_crs)
+    transform = Affine(*transform)
+    
+    # Pixels of the grid overlapping the polygon's bounding box
+    bbox = rasterio.windows.from_bounds(*gpd_feature.total_bounds, 
+                                        transform=transform)
+    row_start = max(int(np.floor(bbox.row_off)), 0)
+    col_start = max(int(np.floor(bbox.col_off)), 0)
+    row_stop = min(int(np.ceil(bbox.row_off + bbox.height)), out_shape[0])
+    col_stop = min(int(np.ceil(bbox.col_off + bbox.width)), out_shape[1])
+    
+    ShapeMask = np.zeros((0, 0), dtype=bool)
+    window = (slice(0, 0), slice(0, 0))
+    if row_stop > row_start and col_stop > col_start:
+        ShapeMask = rasterio.features.geometry_mask(
+            gpd_feature, out_shape=(row_stop - row_start, col_stop - col_start),
+            transform=transform * Affine.translation(col_start, row_start),
+            invert=True)
+        rows = np.flatnonzero(ShapeMask.any(axis=1))
+        cols = np.flatnonzero(ShapeMask.any(axis=0))
+        if len(rows) == 0:
+            ShapeMask = np.zeros((0, 0), dtype=bool)
+        else:
+            ShapeMask = ShapeMask[rows[0]:rows[-1] + 1, 
+                                  cols[0]:cols[-1] + 1].copy()
+            window = (slice(row_start + rows[0], row_start + rows[-1] + 1),
+                      slice(col_start + cols[0], col_start + cols[-1] + 1))
+    ShapeMask.flags.writeable = False
+    return ShapeMask, window
+
+
+def _geopolygon_mask(ds, geopolygon, window=False):
+    """
+    Rasterises `geopolygon` on the grid of `ds` and returns a boolean 
+    DataArray with the spatial dimensions of `ds`, True inside the 
+    polygon. With `window=True` the mask only covers the polygon's
+    bounding window, and is returned with the dictionary of slices 
+    selecting that window in `ds`; otherwise it is padded to the whole
+    grid. Masks are cached, see `_rasterise_geometry`.
+    """
+    from shapely.geometry import shape
     import xarray as xr
-    gpd_geom = [shape(geopolygon)]
-    gpd_feature = gpd.GeoDataFrame({'geometry':gpd_geom}).set_crs(geopolygon.crs).to_crs(ds.rio.crs)
+    ydim, xdim = spatial_dims(ds)
+    grid_shape = (len(ds[ydim]), len(ds[xdim]))
+    ShapeMask, (rows, cols) = _rasterise_geometry(
+        shape(geopolygon).wkt, str(geopolygon.crs), str(ds.rio.crs),
+        grid_shape, tuple(ds.geobox.transform)[:6])
+    if window:
+        return (xr.DataArray(ShapeMask, dims=(ydim, xdim)), 
+                {ydim: rows, xdim: cols})
+    FullMask = np.zeros(grid_shape, dtype=bool)
+    FullMask[rows, cols] = ShapeMask
+    return xr.DataArray(FullMask, dims=(ydim, xdim))
+
+
+def geopolygon_masking(ds, geopolygon, crop=False):
+    """
+    Masks the pixels of `ds` outside `geopolygon` (set to NaN).
     
-    if ('latitude' in ds.dims) and ('longitude' in ds.dims):
-        ShapeMask = rasterio.features.geometry_mask(gpd_feature.iloc[0],
-                                              out_shape=(len(ds.latitude), len(ds.longitude)),
-                                              transform=ds.geobox.transform,
-                                              invert=True)
-        ShapeMask = xr.DataArray(ShapeMask , dims=("latitude", "longitude"))
-    elif ('y' in ds.dims) and ('x' in ds.dims):
-        ShapeMask = rasterio.features.geometry_mask(gpd_feature.iloc[0],
-                                              out_shape=(len(ds.y), len(ds.x)),
-                                              transform=ds.geobox.transform,
-                                              invert=True)
-        ShapeMask = xr.DataArray(ShapeMask , dims=("y", "x"))
+    Parameters
+    ----------
+    ds : xarray.Dataset
+    geopolygon : datacube Geometry (e.g. from `geom_fromdrawn`).
+    crop : bool, optional. If True, the dataset is first cropped to the
+        pixel window of the polygon, so the output only covers its 
+        bounding box. Default is False.
+    """
+    if crop:
+        ShapeMask, window = _geopolygon_mask(ds, geopolygon, window=True)
+        ds = ds.isel(window)
     else:
-        raise Exception(
-                f'Dimensions not recognised; please provide a xarray.Dataset '
-                'with longitude/latitude or x/y dimensions.')
-    
+        ShapeMask = _geopolygon_mask(ds, geopolygon)
     masked_dataset = ds.where(ShapeMask == True)
-    return masked_dataset
\ No newline at end of file
+    return masked_dataset
+
+
+def rasterise_polygons(ds, gdf, id_column=None, all_touched=False):
+    """
+    Rasterises all the polygons of a GeoDataFrame at once into an 
+    integer label raster aligned with the grid of `ds`, to be used with 
+    `zonal_statistics`. Where polygons overlap, the last one wins.
+    
+    Parameters
+    ----------
+    ds : xarray.Dataset
+    gdf : geopandas.GeoDataFrame, e.g. a shapefile of fields.
+    id_column : str, optional. Column of positive integer ids to use as 
+        labels. Default labels the polygons 1 to len(gdf) in row order.
+    all_touched : bool, optional. If True, all the pixels touched by a 
+        polygon are labelled, otherwise only those whose centre is 
+        inside it. Default is False.
+        
+    Returns
+    -------
+    labels : xarray.DataArray (int32) with the spatial dimensions of 
+        `ds`, 0 where no polygon.
+    """
+    import rasterio.features
+    import xarray as xr
+    ydim, xdim = spatial_dims(ds)
+    gdf = gdf.to_crs(ds.rio.crs)
+    if id_column is None:
+        ids = np.arange(1, len(gdf) + 1)
+    else:
+        ids = gdf[id_column].values
+        if ids.dtype.kind not in 'ui' or (ids <= 0).any():
+            raise ValueError(f'{id_column} must contain positive integers.')
+    
+    labels = rasterio.features.rasterize(zip(gdf.geometry, ids.tolist()),
+                                         out_shape=(len(ds[ydim]), len(ds[xdim])),
+                                         transform=ds.geobox.transform,
+                                         fill=0,
+                                         all_touched=all_touched,
+                                         dtype='int32')
+    return xr.DataArray(labels, coords={ydim: ds[ydim], xdim: ds[xdim]},
+                        dims=(ydim, xdim), name='label')
+
+
+def _parse_zonal_stat(stat):
+    """
+    Returns the percentile (0-100) a zonal statistic name stands for 
+    ('median' or 'p' followed by a number, e.g. 'p90'), or None for 
+    'mean', 'min', 'max', 'count', 'sum' and 'std'.
+    """
+    if stat in ['mean', 'min', 'max', 'count', 'sum', 'std']:
+        return None
+    if stat == 'median':
+        return 50.
+    try:
+        q = float(stat[1:]) if stat.startswith('p') else None
+    except ValueError:
+        q = None
+    if q is None or not 0 <= q <= 100:
+        raise ValueError(f'{stat} is not a valid statistic. Please choose '
+                         'from mean, median, min, max, count, sum, std or a '
+                         'percentile such as p90.')
+    return q
+
+
+def _grouped_stats(values, starts, stats):
+    """
+    Computes statistics of groups of contiguous pixels along the last 
+    axis of `values` in one sweep, `starts` giving the first position of
+    each (non-empty) group. Returns an array of shape (..., stat, group);
+    NaN values are ignored.
+    """
+    values = values.astype(np.result_type(values, np.float32), copy=False)
+    isnan = np.isnan(values)
+    count = np.add.reduceat(~isnan, starts, axis=-1)
+    sizes = np.diff(np.append(starts, values.shape[-1]))
+    
+    total = None
+    sorted_values = None
+    out = []
+    for stat in stats:
+        q = _parse_zonal_stat(stat)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if stat in ['sum', 'mean', 'std'] and total is None:
+                total = np.add.reduceat(np.where(isnan, 0, values), starts, axis=-1)
+            if stat == 'count':
+                out.append(count.astype(values.dtype))
+            elif stat == 'sum':
+                out.append(np.where(count > 0, total, np.nan).astype(values.dtype))
+            elif stat == 'mean':
+                out.append((total / count).astype(values.dtype))
+            elif stat == 'std':
+                deviation = values - np.repeat(total / count, sizes, axis=-1)
+                squares = np.add.reduceat(np.where(isnan, 0, deviation**2),
+                                          starts, axis=-1)
+                out.append(np.sqrt(squares / count).astype(values.dtype))
+            elif stat == 'min':
+                out.append(np.fmin.reduceat(values, starts, axis=-1))
+            elif stat == 'max':
+                out.append(np.fmax.reduceat(values, starts, axis=-1))
+            else:
+                if sorted_values is None:
+                    # Sort the values within each group (NaN last), with 
+                    # a stable sort by group of the value-sorted pixels
+                    segment = np.repeat(np.arange(len(starts)), sizes)
+                    by_value = np.argsort(values, axis=-1, kind='stable')
+                    by_label = np.argsort(segment[by_value], axis=-1, kind='stable')
+                    sorted_values = np.take_along_axis(
+                        values, np.take_along_axis(by_value, by_label, axis=-1),
+                        axis=-1)
+                # Linear interpolation, as in numpy.nanpercentile
+                position = starts + (count - 1).clip(0) * q / 100
+                lower = np.floor(position).astype(np.intp)
+                upper = np.ceil(position).astype(np.intp)
+                low = np.take_along_axis(sorted_values, lower, axis=-1)
+                high = np.take_along_axis(sorted_values, upper, axis=-1)
+                result = low + (high - low) * (position - lower)
+                out.append(np.where(count > 0, result, np.nan).astype(values.dtype))
+    return np.stack(out, axis=-2)
+
+
+def _zonal_block(values, order, starts, stats):
+    """
+    Computes the zonal statistics of an array of shape (..., y, x) in 
+    one sweep. `order` sorts the flattened pixels by label (background
+    excluded) and `starts` gives the first position of each label in 
+    that order. Returns an array of shape (..., stat, label); NaN values 
+    are ignored.
+    """
+    values = values.reshape(values.shape[:-2] + (-1,)).take(order, axis=-1)
+    return _grouped_stats(values, starts, stats)
+
+
+def zonal_statistics(ds, labels, stats=['mean']):
+    """
+    Computes per-polygon statistics of every variable of `ds`, for every
+    timestep, in one vectorised sweep over the dataset using a label 
+    raster (see `rasterise_polygons`). NaN pixels are ignored.
+    
+    Parameters
+    ----------
+    ds : xarray.Dataset
+    labels : xarray.DataArray of integer labels with the spatial 
+        dimensions of `ds`, 0 where no polygon.
+    stats : list of str, statistics among 'mean', 'median', 'min', 'max',
+        'count', 'sum', 'std' and percentiles such as 'p10' or 'p90'. 
+        Default is ['mean'].
+        
+    Returns
+    -------
+    zonal_stats : xarray.Dataset with 'label' replacing the spatial 
+        dimensions and one variable per variable and statistic, named
+        e.g. 'NDVI_mean'. Use `.to_dataframe()` for a table.
+    """
+    import xarray as xr
+    if isinstance(stats, str):
+        stats = [stats]
+    for stat in stats:
+        _parse_zonal_stat(stat)
+    
+    ydim, xdim = spatial_dims(ds)
+    flat = np.asarray(labels.transpose(ydim, xdim)).ravel()
+    order = np.argsort(flat, kind='stable')
+    order = order[flat[order] != 0]
+    label_ids, starts = np.unique(flat[order], return_index=True)
+    if len(label_ids) == 0:
+        raise Exception(f'No polygon overlaps the dataset.')
+    
+    zonal_stats = xr.Dataset(coords={'label': label_ids}, attrs=ds.attrs)
+    for var in ds.data_vars:
+        if ydim not in ds[var].dims or xdim not in ds[var].dims:
+            continue
+        result = xr.apply_ufunc(_zonal_block, ds[var],
+                                input_core_dims=[[ydim, xdim]],
+                                output_core_dims=[['stat', 'label']],
+                                kwargs={'order': order, 'starts': starts,
+                                        'stats': stats},
+                                dask='parallelized',
+                                output_dtypes=[np.result_type(ds[var].dtype, np.float32)],
+                                dask_gufunc_kwargs={'output_sizes': {
+                                    'stat': len(stats), 'label': len(label_ids)},
+                                    'allow_rechunk': True})
+        for i, stat in enumerate(stats):
+            zonal_stats[f'{var}_{stat}'] = result.isel(stat=i, drop=True)
+            if stat == 'count':
+                zonal_stats[f'{var}_{stat}'] = zonal_stats[f'{var}_{stat}'].astype('int64')
+    return zonal_stats
+
+
+def _take_pixels(values, index, dtype):
+    """
+    Returns the pixels of an array of shape (..., y, x) at the flat 
+    spatial indices `index`, as an array of shape (..., pixel).
+    """
+    values = values.reshape(values.shape[:-2] + (-1,))
+    return values.take(index, axis=-1).astype(dtype, copy=False)
+
+
+def extract_polygon_pixels(ds, polygons, dtype='float32'):
+    """
+    Extracts the pixels inside one or many polygons into a dense 
+    (time, pixel) dataset, instead of the NaN padded bounding box 
+    returned by `geopolygon_masking`. Pixels are sorted by polygon label,
+    so the pixels of each polygon are contiguous. Use `scatter_pixels` 
+    to put them back on the grid.
+    
+    Parameters
+    ----------
+    ds : xarray.Dataset
+    polygons : datacube Geometry (e.g. from `geom_fromdrawn`), 
+        geopandas.GeoDataFrame or label raster from `rasterise_polygons`.
+    dtype : str, data type of the extracted values. Default is 'float32'.
+    
+    Returns
+    -------
+    pixels : xarray.Dataset with a 'pixel' dimension replacing the 
+        spatial dimensions, and 'label', 'pixel_index' (flat index on the
+        grid of `ds`) and y/x coordinates along it.
+    """
+    import xarray as xr
+    ydim, xdim = spatial_dims(ds)
+    if isinstance(polygons, xr.DataArray):
+        labels = polygons
+    elif hasattr(polygons, 'geometry') and hasattr(polygons, 'to_crs'):
+        labels = rasterise_polygons(ds, polygons)
+    else:
+        labels = _geopolygon_mask(ds, polygons).astype('int32')
+    
+    flat = np.asarray(labels.transpose(ydim, xdim)).ravel()
+    index = np.argsort(flat, kind='stable')
+    index = index[flat[index] != 0]
+    if len(index) == 0:
+        raise Exception(f'No polygon overlaps the dataset.')
+    rows, cols = np.unravel_index(index, (len(ds[ydim]), len(ds[xdim])))
+    
+    pixels = xr.Dataset(attrs=ds.attrs)
+    for var in ds.data_vars:
+        if ydim not in ds[var].dims or xdim not in ds[var].dims:
+            continue
+        pixels[var] = xr.apply_ufunc(_take_pixels, ds[var],
+                                     input_core_dims=[[ydim, xdim]],
+                                     output_core_dims=[['pixel']],
+                                     kwargs={'index': index, 'dtype': dtype},
+                                     dask='parallelized',
+                                     output_dtypes=[dtype],
+                                     dask_gufunc_kwargs={'output_sizes': {
+                                         'pixel': len(index)},
+                                         'allow_rechunk': True},
+                                     keep_attrs=True)
+    return pixels.assign_coords(label=('pixel', flat[index]),
+                                pixel_index=('pixel', index),
+                                **{ydim: ('pixel', ds[ydim].values[rows]),
+                                   xdim: ('pixel', ds[xdim].values[cols])})
+
+
+def scatter_pixels(pixels, ds):
+    """
+    Puts pixels extracted with `extract_polygon_pixels` (or values 
+    computed from them along the same 'pixel' dimension) back on the 
+    grid of `ds`, with NaN outside the polygons.
+    
+    Parameters
+    ----------
+    pixels : xarray.Dataset or xarray.DataArray with a 'pixel' dimension
+        and a 'pixel_index' coordinate.
+    ds : xarray.Dataset or xarray.DataArray with the original grid.
+    
+    Returns
+    -------
+    gridded : xarray.Dataset or xarray.DataArray on the grid of `ds`.
+    """
+    import xarray as xr
+    ydim, xdim = spatial_dims(ds)
+    height, width = len(ds[ydim]), len(ds[xdim])
+    index = pixels.pixel_index.values
+    
+    def _scatter(array):
+        array = array.transpose(..., 'pixel')
+        dtype = np.result_type(array.dtype, np.float32)
+        grid = np.full(array.shape[:-1] + (height * width,), np.nan, dtype=dtype)
+        grid[..., index] = array.values
+        return xr.DataArray(grid.reshape(array.shape[:-1] + (height, width)),
+                            coords={**{dim: array[dim] for dim in array.dims[:-1]
+                                       if dim in array.coords},
+                                    ydim: ds[ydim], xdim: ds[xdim]},
+                            dims=array.dims[:-1] + (ydim, xdim),
+                            attrs=array.attrs)
+    
+    if isinstance(pixels, xr.DataArray):
+        return _scatter(pixels)
+    return xr.Dataset({var: _scatter(pixels[var]) for var in pixels.data_vars
+                       if 'pixel' in pixels[var].dims}, attrs=pixels.attrs)
+
+
+def load_s2_cloud_filtered(dc, query, cloud_threshold=20, geopolygon=None,
+                           scl_resolution=None):
+    """
+    Loads Sentinel-2 data in two phases so that bands are only read for
+    the dates that are clear enough to be used. First, only the 'scl' 
+    (scene classification) layer is loaded, optionally at a coarser
+    resolution, and the cloud (i.e., non-valid) coverage of each date is 
+    computed inside the area of interest. Then, all the measurements of 
+    the query are loaded for the dates with a cloud coverage lower than 
+    or equal to `cloud_threshold` only.
+    
+    Parameters
+    ----------
+    dc : datacube.Datacube instance.
+    query : dict, query for `dc.load` (e.g. with 'product', 'x', 'y' or 
+        'geopolygon', 'time', 'measurements', 'output_crs' and 
+        'resolution' keys).
+    cloud_threshold : int or float between 0 and 100, or the slider 
+        returned by `display_tools.cloud_threshold_slider`. Maximum cloud
+        coverage (%) of the dates to load. Default is 20.
+    geopolygon : datacube Geometry, optional. Area of interest the cloud
+        coverage is computed in, e.g. a field from `geom_fromdrawn`. 
+        Defaults to the 'geopolygon' of the query if there is one, or to
+        the whole extent otherwise.
+    scl_resolution : tuple, optional. Resolution used to load the 'scl' 
+        layer, e.g. (-60, 60). Defaults to the resolution of the query.
+        
+    Returns
+    -------
+    ds : xarray.Dataset with the dates under the cloud threshold, and 
+        a 'cloud_coverage' coordinate along time.
+    """
+    import xarray as xr
+    from datacube import Datacube
+    from datacube.api.query import query_group_by
+    
+    cloud_threshold = getattr(cloud_threshold, 'value', cloud_threshold)
+    if geopolygon is None:
+        geopolygon = query.get('geopolygon')
+    
+    # Find the datasets once, so both phases load exactly the same scenes
+    load_only = ['measurements', 'output_crs', 'resolution', 'align',
+                 'resampling', 'dask_chunks', 'group_by', 'fuse_func',
+                 'skip_broken_datasets', 'progress_cbk']
+    search = {key: value for key, value in query.items() 
+              if key not in load_only}
+    datasets = dc.find_datasets(**search)
+    if len(datasets) == 0:
+        raise Exception(f'No datasets were found for this query.')
+    
+    # Phase 1: load the scene classification only
+    scl_query = dict(query, measurements=['scl'])
+    if scl_resolution is not None:
+        scl_query['resolution'] = scl_resolution
+    scl = dc.load(datasets=datasets, **scl_query).scl
+    
+    ydim, xdim = spatial_dims(scl)
+    valid = xr.apply_ufunc(_valid_scl, scl, dask='parallelized',
+                           output_dtypes=[bool])
+    if geopolygon is not None:
+        inside = _geopolygon_mask(scl, geopolygon)
+        valid = valid & inside
+        area_total_size = int(inside.sum())
+    else:
+        area_total_size = len(scl[ydim]) * len(scl[xdim])
+    cloud_percentage = (100 - valid.sum([ydim, xdim]) / area_total_size * 100
+                        ).compute()
+    
+    clear = cloud_percentage.time[cloud_percentage <= cloud_threshold]
+    print(f'{len(clear)} out of {len(cloud_percentage.time)} dates have a '
+          f'cloud coverage lower than or equal to {cloud_threshold}%.')
+    if len(clear) == 0:
+        raise Exception(f'No date has a cloud coverage lower than or equal '
+                        f'to {cloud_threshold}%; try a higher threshold.')
+    
+    # Phase 2: load all measurements for the clear dates only, grouping 
+    # the datasets the same way dc.load does
+    grouped = Datacube.group_datasets(datasets, query_group_by(**query))
+    clear_datasets = [dataset for group in grouped.sel(time=clear).values
+                      for dataset in group]
+    ds = dc.load(datasets=clear_datasets, **query)
+    ds = ds.assign_coords(cloud_coverage=('time', 
+                          cloud_percentage.sel(time=ds.time).values))
+    return ds
\ No newline at end of file